@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from peerProcess import MessageFramer
+
+# Decode throughput of the receive framing, in messages per second. A recorded byte stream is
+# fed to the decoder in fixed size chunks the way recv hands them out. The legacy decoder is the
+# loop main() used to run (append to a bytearray, slice the message off, re-slice the rest).
+# Both decoders must count every message; the run is rejected otherwise.
+
+class ReplaySocket():
+    def __init__(self, stream: bytes, chunk_size: int):
+        self.stream = memoryview(stream)
+        self.chunk_size = chunk_size
+        self.offset = 0
+
+    def recv(self, size):
+        size = min(size, self.chunk_size)
+        data = self.stream[self.offset:self.offset + size].tobytes()
+        self.offset += len(data)
+        return data
+
+    def recv_into(self, view):
+        size = min(len(view), self.chunk_size, len(self.stream) - self.offset)
+        view[:size] = self.stream[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+def make_stream(num_messages: int, piece_size: int, piece_every: int):
+    # Mostly 9 byte 'have' messages with a piece message mixed in every piece_every messages
+    have = (5).to_bytes(4, byteorder='big') + (4).to_bytes(1, byteorder='big') + (7).to_bytes(4, byteorder='big')
+    piece = (piece_size + 5).to_bytes(4, byteorder='big') + (7).to_bytes(1, byteorder='big') + (7).to_bytes(4, byteorder='big') + bytes(piece_size)
+    parts = [piece if piece_every and i % piece_every == 0 else have for i in range(num_messages)]
+    return b"".join(parts)
+
+def legacy_decode(sock, max_msg_size):
+    buffer = bytearray()
+    next_length = 0
+    count = 0
+    while True:
+        data = sock.recv(max_msg_size)
+        if not data:
+            return count
+        buffer += data
+        while len(buffer) > next_length:
+            if next_length == 0:
+                # Not in the original loop, which read a length out of a partial header
+                # whenever a recv boundary split one and then stalled
+                if len(buffer) < 4:
+                    break
+                next_length = int.from_bytes(buffer[0:4], byteorder='big') + 4
+            if len(buffer) < next_length:
+                break
+            message = buffer[0:next_length]
+            buffer = buffer[next_length:]
+            next_length = 0
+            count += len(message) > 0
+
+def framer_decode(sock, max_msg_size):
+    framer = MessageFramer(max_msg_size)
+    count = 0
+    while framer.receive(sock):
+        for message in framer.messages():
+            count += 1
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive framing decode throughput")
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--piece-size", type=int, default=16384)
+    parser.add_argument("--piece-every", type=int, default=50, help="0 for control messages only")
+    parser.add_argument("--chunk", type=int, default=65536, help="bytes returned per recv")
+    args = parser.parse_args()
+
+    exponent = (args.piece_size + 9 - 1).bit_length()
+    max_msg_size = 2**(exponent + 2)
+    stream = make_stream(args.messages, args.piece_size, args.piece_every)
+    for label, decode in (("legacy", legacy_decode), ("framer", framer_decode)):
+        sock = ReplaySocket(stream, args.chunk)
+        start = time.perf_counter()
+        count = decode(sock, max_msg_size)
+        elapsed = time.perf_counter() - start
+        if count != args.messages:
+            raise RuntimeError(f"{label} decoded {count} of {args.messages} messages")
+        print(f"{label:>6}: {count/elapsed:12.0f} messages/s ({len(stream)/elapsed/2**20:8.1f} MiB/s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import queue
+import logging
+import logging.handlers
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from peerProcess import DeferredQueueHandler, BatchedFileHandler, BatchingQueueListener
+
+# Cost of a 'have' log line on the thread handling messages. The legacy path is what the peers used
+# to do (f-string, then a FileHandler writing on the calling thread); the queued path is the current
+# one (%-style arguments, record attributes the format does not use switched off, DeferredQueueHandler,
+# a BatchingQueueListener writing the file). Both files must come out identical.
+
+FORMAT = '%(asctime)s : %(message)s'
+
+def legacy(path, count):
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    logging.getLogger().handlers = [handler]
+    peer_id, neighbor_id = 1002, 1003
+    start = time.perf_counter()
+    for piece_index in range(count):
+        logging.info(f"Peer {peer_id} received the \'have\' message from Peer {neighbor_id} for the piece {piece_index}")
+    caller = time.perf_counter() - start
+    handler.close()
+    return caller, time.perf_counter() - start
+
+def queued(path, count):
+    log_queue = queue.SimpleQueue()
+    handler = BatchedFileHandler(path)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    listener = BatchingQueueListener(log_queue, handler)
+    logging.getLogger().handlers = [DeferredQueueHandler(log_queue)]
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    listener.start()
+    peer_id, neighbor_id = 1002, 1003
+    start = time.perf_counter()
+    for piece_index in range(count):
+        logging.info("Peer %s received the 'have' message from Peer %s for the piece %s", peer_id, neighbor_id, piece_index)
+    caller = time.perf_counter() - start
+    listener.stop()
+    handler.close()
+    return caller, time.perf_counter() - start
+
+def messages(path):
+    with open(path, "r") as file:
+        return [line.split(" : ", 1)[1] for line in file]
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-record cost of the peer log on the calling thread")
+    parser.add_argument("--records", type=int, default=100000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="logging_bench_")
+    try:
+        logging.getLogger().setLevel(logging.INFO)
+        paths = dict()
+        for label, run in (("legacy", legacy), ("queued", queued)):
+            paths[label] = os.path.join(workdir, f"{label}.log")
+            caller, total = run(paths[label], args.records)
+            print(f"{label:>6}: {caller/args.records*1e6:6.2f} us per record on the caller, {total/args.records*1e6:6.2f} us until written")
+        if messages(paths["legacy"]) != messages(paths["queued"]):
+            raise RuntimeError("The two logs differ")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
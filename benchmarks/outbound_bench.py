@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from peerProcess import PeerProcess, OutboundQueue
+
+# Send syscalls per received piece on a leecher's control traffic. For every piece that arrives the
+# peer sends a 'have' to each neighbor and a new 'request' to the sender, which is what accept_piece
+# does. The legacy path is the old send_message (one sendall per message); the queued path goes
+# through OutboundQueue and reads its counters. Pieces arrive in bursts of --burst, as they do when
+# a recv hands several piece messages to the receive loop at once.
+
+def drain(conn, total):
+    buffer = bytearray(1 << 16)
+    received = 0
+    while received < total:
+        n = conn.recv_into(buffer)
+        if n == 0:
+            break
+        received += n
+
+def run(label, peer, num_neighbors, num_pieces, burst, make_sender):
+    pairs = [socket.socketpair() for _ in range(num_neighbors)]
+    have = peer.encode_message(4, (0).to_bytes(4, byteorder='big'))
+    request = peer.encode_message(6, (0).to_bytes(4, byteorder='big'))
+    #Every neighbor gets the haves, neighbor 0 also gets the requests
+    totals = [num_pieces * len(have) + (num_pieces * len(request) if i == 0 else 0) for i in range(num_neighbors)]
+    readers = [threading.Thread(target=drain, args=(pair[1], total)) for pair, total in zip(pairs, totals)]
+    for reader in readers:
+        reader.start()
+    send, finish = make_sender([pair[0] for pair in pairs])
+    start = time.perf_counter()
+    for piece_index in range(num_pieces):
+        for neighbor in range(num_neighbors):
+            send(neighbor, have)
+        send(0, request)
+        if (piece_index + 1) % burst == 0:
+            #Time the receive loop would spend waiting for the next recv
+            time.sleep(0.001)
+    calls = finish()
+    for reader in readers:
+        reader.join()
+    elapsed = time.perf_counter() - start
+    for pair in pairs:
+        pair[0].close()
+        pair[1].close()
+    print(f"{label:>7}: {calls/num_pieces:6.2f} send calls per piece, {elapsed:6.3f} s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Control message send syscalls per received piece")
+    parser.add_argument("--neighbors", type=int, default=8)
+    parser.add_argument("--pieces", type=int, default=5000)
+    parser.add_argument("--burst", type=int, default=4, help="pieces handled per receive loop wakeup")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="outbound_bench_")
+    try:
+        os.chdir(workdir)
+        peer = PeerProcess(1, "127.0.0.1", 0, False, 1, 5, 15, "bench.bin", 16384, 16384, [])
+
+        def legacy(conns):
+            count = [0]
+            def send(neighbor, message):
+                conns[neighbor].sendall(message)
+                count[0] += 1
+            return send, lambda: count[0]
+
+        def queued(conns):
+            queues = [OutboundQueue(i, conn, peer.piece_store) for i, conn in enumerate(conns)]
+            def send(neighbor, message):
+                queues[neighbor].put_message(message)
+            def finish():
+                for queue in queues:
+                    queue.close(60)
+                return sum(queue.sent.send_calls for queue in queues)
+            return send, finish
+
+        run("legacy", peer, args.neighbors, args.pieces, args.burst, legacy)
+        run("queued", peer, args.neighbors, args.pieces, args.burst, queued)
+        peer.listening_socket.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
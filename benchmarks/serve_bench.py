@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import socket
+import select
+import resource
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from peerProcess import PeerProcess, PeerInfo
+
+# How fast a seed serves requests to several neighbors over loopback, with or without upload workers
+# (UploadWorkers in Common.cfg). The neighbors run in a separate process, each one unchoked and keeping
+# --depth requests in flight until it has the whole file. The seed's sockets are read by the same
+# receive_from the peer's own receive loop uses. CPU time is split between the peer process, which with
+# workers only hands off connections and relays messages, and the worker processes, so it shows how much
+# of the serving left the peer's core. Run once per worker count, e.g. --workers 0 then --workers 4.
+
+def client_main(port: int, neighbors: int, num_pieces: int, piece_size: int, file_size: int, depth: int, results):
+    conns = [socket.create_connection(("127.0.0.1", port)) for _ in range(neighbors)]
+    buffers = {conn: bytearray() for conn in conns}
+    next_piece = {conn: 0 for conn in conns}
+    received = {conn: 0 for conn in conns}
+    unchoked = set()
+    expected = neighbors * (file_size + 9 * num_pieces)
+    total = 0
+    start = None
+
+    def request(conn):
+        piece_index = next_piece[conn]
+        next_piece[conn] += 1
+        conn.sendall((5).to_bytes(4, byteorder='big') + (6).to_bytes(1, byteorder='big') + piece_index.to_bytes(4, byteorder='big'))
+
+    while total < expected:
+        readable, _, _ = select.select(conns, [], [])
+        for conn in readable:
+            data = conn.recv(1 << 20)
+            if not data:
+                raise RuntimeError("The seed closed a connection")
+            buffer = buffers[conn]
+            buffer += data
+            offset = 0
+            while len(buffer) - offset >= 5:
+                length = int.from_bytes(buffer[offset:offset + 4], byteorder='big') + 4
+                if len(buffer) - offset < length:
+                    break
+                msg_type = buffer[offset + 4]
+                if msg_type == 1 and conn not in unchoked:
+                    unchoked.add(conn)
+                    if start is None:
+                        start = time.perf_counter()
+                    for _ in range(min(depth, num_pieces)):
+                        request(conn)
+                elif msg_type == 7:
+                    total += length
+                    received[conn] += 1
+                    if next_piece[conn] < num_pieces:
+                        request(conn)
+                offset += length
+            del buffer[:offset]
+    elapsed = time.perf_counter() - start
+    results.send((elapsed, total, time.process_time()))
+    for conn in conns:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed request serving throughput with and without upload workers")
+    parser.add_argument("--workers", type=int, default=0, help="UploadWorkers, 0 serves in the peer process")
+    parser.add_argument("--neighbors", type=int, default=4)
+    parser.add_argument("--size", type=int, default=64*2**20, help="file size in bytes, every neighbor downloads all of it")
+    parser.add_argument("--piece-size", type=int, default=16384)
+    parser.add_argument("--depth", type=int, default=8, help="requests each neighbor keeps in flight, also RequestPipelineDepth")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="serve_bench_")
+    try:
+        os.chdir(workdir)
+        os.mkdir("peer_1")
+        with open(f"{workdir}/peer_1/bench.bin", "wb") as file_bytes:
+            file_bytes.write(os.urandom(args.size))
+        peer = PeerProcess(1, "127.0.0.1", 0, True, args.neighbors, 5, 15, "bench.bin", args.size, args.piece_size, [],
+                           request_pipeline_depth=args.depth, compression=False, upload_workers=args.workers)
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(args.neighbors)
+        context = multiprocessing.get_context("spawn")
+        results, client_results = context.Pipe()
+        client = context.Process(target=client_main, args=(listener.getsockname()[1], args.neighbors, peer.num_pieces,
+                                                           args.piece_size, args.size, args.depth, client_results))
+        client.start()
+        for index in range(args.neighbors):
+            conn, _ = listener.accept()
+            peer_id = 2 + index
+            with peer.state_lock:
+                peer.setup_neighbor(PeerInfo(peer_id, "127.0.0.1", 0, '0'))
+                if peer.register_socket(peer_id, conn):
+                    peer.sockets_list.append(conn)
+                peer.preferred_neighbors.add(peer_id)
+                peer.send_message(peer_id, 1)
+
+        cpu_start = time.process_time()
+        while True:
+            readable, _, _ = select.select(peer.sockets_list + [results], [], [])
+            if results in readable:
+                break
+            for sock in readable:
+                peer.receive_from(sock)
+        peer_cpu = time.process_time() - cpu_start
+        elapsed, total, client_cpu = results.recv()
+        client.join()
+        with peer.state_lock:
+            peer.close_outbound(10)
+        worker_cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+        worker_cpu = worker_cpu.ru_utime + worker_cpu.ru_stime - client_cpu
+        pieces = args.neighbors * peer.num_pieces
+        print(f"workers {args.workers}: {total/elapsed/2**20:8.1f} MiB/s, CPU per piece {peer_cpu/pieces*1e6:6.1f} us in the peer process, "
+              f"{worker_cpu/pieces*1e6:6.1f} us in workers, {client_cpu/pieces*1e6:6.1f} us in the neighbors")
+        for conn in peer.connections.values():
+            conn.close()
+        listener.close()
+        peer.listening_socket.close()
+        peer.piece_store.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
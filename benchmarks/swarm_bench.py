@@ -0,0 +1,448 @@
+import os
+import sys
+import json
+import random
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import datetime
+import tempfile
+import threading
+import filecmp
+import subprocess
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from peerProcess import PieceManifest, PieceStore
+
+# Runs a whole swarm on loopback and reports how it performed. A random file, or with --content text
+# a compressible log-like one, is generated for the seeds, and every peer gets its own working directory with its own PeerInfo.cfg and Common.cfg.
+# With --latency or --bandwidth every listening port is fronted by a proxy and the other peers are
+# pointed at the proxy instead. A list of bandwidths is handed out to the peers in turn, which makes
+# some of them slower than others, and --seed-uplink caps what each seed sends over all of its connections
+# together. Timings come from the peers' own logs, including when each peer
+# had a connection to every other peer and when the leechers between them first held every piece
+# (the first distributed copy, which is what a seed's uplink has to pay for), and CPU time and peak RSS
+# come from os.wait4. Every leecher's copy is compared byte for byte with the original. Use --json
+# to keep the results for comparing runs. With --restart the last leecher is killed with SIGKILL once
+# its log shows that fraction of the pieces, and started again in the same directory after --restart-delay,
+# while the rest of the swarm keeps running. It has to resume from its checkpoint and get back into the swarm.
+
+PEER_PROCESS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "peerProcess.py")
+FIRST_PEER_ID = 1001
+
+class LinkProxy():
+    #Forwards connections to one peer's listening port. Each direction of each connection delays
+    #data by latency seconds and paces it to at most bandwidth bytes per second. With an uplink, what
+    #the peer sends back over all of its connections is also paced to that many bytes per second in total.
+    #That is all the peer uploads when every other peer dials it, as they do a seed listed first in PeerInfo.cfg.
+    def __init__(self, target_port: int, latency: float, bandwidth: int, uplink: int = 0):
+        self.target_port = target_port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.uplink = uplink
+        self.uplink_free = 0
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, client_reader, client_writer):
+        try:
+            target_reader, target_writer = await asyncio.open_connection("127.0.0.1", self.target_port)
+        except OSError:
+            client_writer.close()
+            return
+        await asyncio.gather(self.pipe(client_reader, target_writer), self.pipe(target_reader, client_writer, self.uplink))
+
+    async def pipe(self, reader, writer, uplink: int = 0):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        async def receive():
+            while True:
+                try:
+                    data = await reader.read(65536)
+                except OSError:
+                    data = b""
+                await queue.put((loop.time() + self.latency, data))
+                if not data:
+                    return
+
+        receiver = loop.create_task(receive())
+        next_free = loop.time()
+        try:
+            while True:
+                due, data = await queue.get()
+                if not data:
+                    break
+                if self.bandwidth:
+                    next_free = max(next_free, due) + len(data) / self.bandwidth
+                    due = next_free
+                if uplink:
+                    #Shared by the peer's connections, which all run on this loop
+                    self.uplink_free = max(self.uplink_free, due) + len(data) / uplink
+                    due = self.uplink_free
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+        except OSError:
+            pass
+        finally:
+            receiver.cancel()
+            writer.close()
+
+
+class ProxyThread():
+    #Runs the proxies on an event loop of their own next to the harness
+    def __init__(self, ports, latency: float, bandwidths, uplinks):
+        self.loop = asyncio.new_event_loop()
+        self.proxies = [LinkProxy(port, latency, bandwidths[index % len(bandwidths)], uplinks[index]) for index, port in enumerate(ports)]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        for proxy in self.proxies:
+            asyncio.run_coroutine_threadsafe(proxy.start(), self.loop).result()
+
+    def ports(self):
+        return [proxy.port for proxy in self.proxies]
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def free_ports(count: int):
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(count)]
+    for sock in sockets:
+        sock.bind(("127.0.0.1", 0))
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+def log_time(line: str):
+    #Log lines start with logging's default asctime, local time with milliseconds
+    return datetime.datetime.strptime(line[:23], "%Y-%m-%d %H:%M:%S,%f").timestamp()
+
+def read_log(path: str, num_neighbors: int):
+    first_piece = None
+    completed = None
+    connected = None
+    connections = 0
+    #(time, piece index, peer it came from) of every piece downloaded
+    downloads = list()
+    if not os.path.exists(path):
+        return first_piece, completed, connected, downloads
+    with open(path, "r") as file:
+        for line in file:
+            if connected is None and ("makes a connection to" in line or "is connected from" in line):
+                connections += 1
+                if connections == num_neighbors:
+                    connected = log_time(line)
+            elif "has downloaded the piece" in line:
+                words = line.split()
+                downloads.append((log_time(line), int(words[9]), int(words[11].rstrip("."))))
+                if first_piece is None:
+                    first_piece = log_time(line)
+            elif "has downloaded the complete file" in line:
+                completed = log_time(line)
+    return first_piece, completed, connected, downloads
+
+def distributed_copy(downloads, num_pieces: int):
+    #Time at which every piece had reached at least one leecher
+    seen = set()
+    for at, piece_index, _ in sorted(downloads):
+        seen.add(piece_index)
+        if len(seen) == num_pieces:
+            return at
+    return None
+
+def text_chunk(size: int):
+    #Log-like lines, compresses about as well as real logs and CSVs do
+    events = ["accepted connection", "request served", "cache miss", "retrying upload", "session closed"]
+    lines = list()
+    length = 0
+    while length < size:
+        line = (f"2026-10-17 12:{random.randrange(60):02d}:{random.randrange(60):02d},{random.randrange(1000):03d} "
+                f"host{random.randrange(64):02d} worker[{random.randrange(40000)}]: {random.choice(events)} "
+                f"id={random.getrandbits(32):08x} took {random.randrange(5000)} ms\n")
+        lines.append(line)
+        length += len(line)
+    return "".join(lines).encode()[:size]
+
+def percentile(values, fraction: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def setup_swarm(args, workdir: str):
+    peer_ids = [FIRST_PEER_ID + i for i in range(args.peers)]
+    ports = free_ports(args.peers)
+    proxy = None
+    advertised = ports
+    bandwidths = [int(value) for value in args.bandwidth.split(",")]
+    uplinks = [args.seed_uplink if index < args.seeds else 0 for index in range(args.peers)]
+    if args.latency or any(bandwidths) or args.seed_uplink:
+        proxy = ProxyThread(ports, args.latency / 1000, bandwidths, uplinks)
+        advertised = proxy.ports()
+
+    common = [f"NumberOfPreferredNeighbors {args.preferred}",
+              f"UnchokingInterval {args.unchoke}",
+              f"OptimisticUnchokingInterval {args.optimistic_unchoke}",
+              f"FileName {args.file_name}",
+              f"FileSize {args.size}",
+              f"PieceSize {args.piece_size}"] + args.common
+
+    source = os.path.join(workdir, args.file_name)
+    with open(source, "wb") as file:
+        remaining = args.size
+        while remaining > 0:
+            chunk = min(remaining, 1 << 24)
+            file.write(os.urandom(chunk) if args.content == "random" else text_chunk(chunk))
+            remaining -= chunk
+    manifest_path = None
+    if not args.no_manifest:
+        manifest_path = os.path.join(workdir, f"{args.file_name}.manifest")
+        store = PieceStore(source, args.size, args.piece_size, True)
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            PieceManifest.build(store, pool).write(manifest_path)
+        store.close()
+
+    peer_dirs = dict()
+    for index, peer_id in enumerate(peer_ids):
+        peer_dir = os.path.join(workdir, f"run_{peer_id}")
+        os.makedirs(os.path.join(peer_dir, f"peer_{peer_id}"))
+        with open(os.path.join(peer_dir, "PeerInfo.cfg"), "w") as file:
+            for other_index, other_id in enumerate(peer_ids):
+                #A peer binds the port on its own line, the others are reached through the proxy if there is one
+                port = ports[other_index] if other_id == peer_id else advertised[other_index]
+                file.write(f"{other_id} 127.0.0.1 {port} {1 if other_index < args.seeds else 0}\n")
+        with open(os.path.join(peer_dir, "Common.cfg"), "w") as file:
+            file.write("\n".join(common) + "\n")
+        if manifest_path is not None:
+            shutil.copy(manifest_path, peer_dir)
+        if index < args.seeds:
+            shutil.copy(source, os.path.join(peer_dir, f"peer_{peer_id}", args.file_name))
+        peer_dirs[peer_id] = peer_dir
+    return peer_ids, peer_dirs, source, proxy
+
+def engine_of(args, index: int):
+    if args.engine == "mixed":
+        return "asyncio" if index % 2 else "threaded"
+    return args.engine
+
+def launch(args, peer_ids, peer_dirs, peer_id: int):
+    #A restarted peer appends to the log and stderr of its first run
+    with open(os.path.join(peer_dirs[peer_id], "stderr.txt"), "a") as errors:
+        return subprocess.Popen([sys.executable, PEER_PROCESS, str(peer_id), "--engine", engine_of(args, peer_ids.index(peer_id))],
+                                cwd=peer_dirs[peer_id], stdout=subprocess.DEVNULL, stderr=errors)
+
+def pieces_logged(path: str):
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r") as file:
+        return sum(1 for line in file if "has downloaded the piece" in line)
+
+def run_swarm(args, peer_ids, peer_dirs):
+    processes = dict()
+    started = dict()
+    usage = dict()
+    try:
+        for peer_id in peer_ids:
+            started[peer_id] = time.time()
+            processes[peer_id] = launch(args, peer_ids, peer_dirs, peer_id)
+            time.sleep(args.gap)
+
+        #The peer killed by --restart, the pieces its log showed when it was killed, the rusage of the killed run,
+        #and when to start it again
+        restart = None
+        if args.restart:
+            victim = peer_ids[-1]
+            restart = {"peer_id": victim, "log": os.path.join(peer_dirs[victim], f"log_peer_{victim}.log"),
+                       "pieces_at_kill": None, "rusage": None, "relaunch_at": None}
+        num_pieces = -(-args.size // args.piece_size)
+        deadline = time.time() + args.timeout
+        while len(usage) < len(processes):
+            if restart is not None and restart["pieces_at_kill"] is None and restart["peer_id"] not in usage:
+                logged = pieces_logged(restart["log"])
+                if logged >= args.restart * num_pieces:
+                    process = processes[restart["peer_id"]]
+                    process.kill()
+                    _, _, restart["rusage"] = os.wait4(process.pid, 0)
+                    restart["pieces_at_kill"] = logged
+                    restart["relaunch_at"] = time.time() + args.restart_delay
+            if restart is not None and restart["relaunch_at"] is not None and time.time() >= restart["relaunch_at"]:
+                processes[restart["peer_id"]] = launch(args, peer_ids, peer_dirs, restart["peer_id"])
+                restart["relaunch_at"] = None
+            #The killed run was already waited for, its second one has not started yet
+            down = restart["peer_id"] if restart is not None and restart["relaunch_at"] is not None else None
+            for peer_id, process in processes.items():
+                if peer_id in usage or peer_id == down:
+                    continue
+                pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+                if pid != 0:
+                    usage[peer_id] = (os.waitstatus_to_exitcode(status), rusage, time.time())
+            if time.time() > deadline:
+                for peer_id, process in processes.items():
+                    if peer_id == down:
+                        usage[peer_id] = (None, restart["rusage"], time.time())
+                        restart["rusage"] = None
+                    elif peer_id not in usage:
+                        process.kill()
+                        _, status, rusage = os.wait4(process.pid, 0)
+                        usage[peer_id] = (None, rusage, time.time())
+                break
+            time.sleep(0.05)
+    finally:
+        #Peers keep redialing for as long as they run, so none is left behind if the run fails or is interrupted
+        for peer_id, process in processes.items():
+            if peer_id not in usage:
+                process.kill()
+                process.wait()
+    return started, usage, restart
+
+def read_resume(path: str):
+    #Pieces the restarted peer found on disk, from the line logged by its second run
+    with open(path, "r") as file:
+        for line in file:
+            if "resumed with" in line:
+                return int(line.split("resumed with ")[1].split()[0])
+    return 0
+
+def report(args, peer_ids, peer_dirs, source, started, usage, restart):
+    swarm_start = min(started.values())
+    results = list()
+    downloads = list()
+    for index, peer_id in enumerate(peer_ids):
+        first_piece, completed, connected, peer_downloads = read_log(os.path.join(peer_dirs[peer_id], f"log_peer_{peer_id}.log"), len(peer_ids) - 1)
+        exit_code, rusage, _ = usage[peer_id]
+        cpu = rusage.ru_utime + rusage.ru_stime
+        if restart is not None and restart["peer_id"] == peer_id and restart["rusage"] is not None:
+            cpu += restart["rusage"].ru_utime + restart["rusage"].ru_stime
+        copy = os.path.join(peer_dirs[peer_id], f"peer_{peer_id}", args.file_name)
+        seed = index < args.seeds
+        downloads.extend(peer_downloads)
+        results.append({
+            "peer_id": peer_id,
+            "seed": seed,
+            "engine": engine_of(args, index),
+            "exit_code": exit_code,
+            "verified": seed or (os.path.exists(copy) and filecmp.cmp(source, copy, shallow=False)),
+            "connected": None if connected is None else connected - started[peer_id],
+            "connected_at": None if connected is None else connected - swarm_start,
+            "first_piece": None if seed or first_piece is None else first_piece - started[peer_id],
+            "completion": None if seed or completed is None else completed - started[peer_id],
+            "completed_at": None if seed or completed is None else completed - swarm_start,
+            "cpu": cpu,
+            "max_rss_kib": rusage.ru_maxrss,
+        })
+
+    print(f"{'peer':>6} {'engine':>8} {'exit':>5} {'ok':>3} {'connected':>10} {'first piece':>12} {'completion':>11} {'cpu s':>7} {'rss MiB':>8}")
+    for result in results:
+        connected = "-" if result["connected"] is None else f"{result['connected']:.3f}"
+        first_piece = "seed" if result["seed"] else ("-" if result["first_piece"] is None else f"{result['first_piece']:.3f}")
+        completion = "seed" if result["seed"] else ("-" if result["completion"] is None else f"{result['completion']:.3f}")
+        print(f"{result['peer_id']:>6} {result['engine']:>8} {str(result['exit_code']):>5} {'yes' if result['verified'] else 'NO':>3} "
+              f"{connected:>10} {first_piece:>12} {completion:>11} {result['cpu']:7.2f} {result['max_rss_kib']/1024:8.1f}")
+
+    leechers = [result for result in results if not result["seed"]]
+    finished = [result for result in leechers if result["completed_at"] is not None]
+    summary = {"peers": args.peers, "seeds": args.seeds, "size": args.size, "piece_size": args.piece_size,
+               "latency_ms": args.latency, "bandwidth": args.bandwidth, "seed_uplink": args.seed_uplink, "engine": args.engine, "content": args.content, "common": args.common,
+               "all_verified": all(result["verified"] for result in results) and len(finished) == len(leechers)}
+    connected = [result["connected"] for result in results if result["connected"] is not None]
+    if len(connected) == len(results):
+        #Time from the first launch until every pair of peers is connected
+        summary.update({"mesh_time": max(result["connected_at"] for result in results),
+                        "connected_p50": percentile(connected, 0.5),
+                        "connected_max": max(connected)})
+        print(f"mesh connected {summary['mesh_time']:.3f} s after the first launch, per peer p50 {summary['connected_p50']:.3f} s max {summary['connected_max']:.3f} s")
+    else:
+        print(f"{len(results) - len(connected)} peers never connected to every other peer")
+    num_pieces = -(-args.size // args.piece_size)
+    if restart is not None:
+        if restart["pieces_at_kill"] is None:
+            summary["all_verified"] = False
+            print(f"Peer {restart['peer_id']} finished before it could be restarted")
+        else:
+            summary["restart"] = {"peer_id": restart["peer_id"], "pieces_at_kill": restart["pieces_at_kill"],
+                                  "pieces_resumed": read_resume(restart["log"])}
+            print(f"Peer {restart['peer_id']} was killed after logging {restart['pieces_at_kill']} of {num_pieces} pieces "
+                  f"and resumed with {summary['restart']['pieces_resumed']} of them")
+    seeds = set(peer_ids[:args.seeds])
+    copy_at = distributed_copy(downloads, num_pieces)
+    summary["seed_pieces_uploaded"] = sum(1 for _, _, from_id in downloads if from_id in seeds)
+    summary["distributed_copy_time"] = None if copy_at is None else copy_at - swarm_start
+    if copy_at is not None:
+        print(f"first distributed copy {summary['distributed_copy_time']:.3f} s after the first launch, "
+              f"seeds uploaded {summary['seed_pieces_uploaded']} pieces ({summary['seed_pieces_uploaded']/num_pieces:.2f} copies of the file)")
+    if finished:
+        swarm_time = max(result["completed_at"] for result in finished)
+        completions = [result["completion"] for result in finished]
+        first_pieces = [result["first_piece"] for result in finished if result["first_piece"] is not None]
+        summary.update({
+            "swarm_time": swarm_time,
+            "aggregate_throughput": args.size * len(finished) / swarm_time,
+            "completion_p50": percentile(completions, 0.5),
+            "completion_p90": percentile(completions, 0.9),
+            "completion_max": max(completions),
+            "first_piece_p50": percentile(first_pieces, 0.5) if first_pieces else None,
+            "cpu_total": sum(result["cpu"] for result in results),
+            "max_rss_kib": max(result["max_rss_kib"] for result in results),
+        })
+        print(f"swarm done in {swarm_time:.3f} s, aggregate {summary['aggregate_throughput']/2**20:.1f} MiB/s, "
+              f"completion p50 {summary['completion_p50']:.3f} s p90 {summary['completion_p90']:.3f} s max {summary['completion_max']:.3f} s, "
+              f"first piece p50 {summary['first_piece_p50'] if summary['first_piece_p50'] is not None else float('nan'):.3f} s, "
+              f"cpu {summary['cpu_total']:.2f} s")
+    print("PASS" if summary["all_verified"] else f"FAIL: {len(leechers) - len(finished)} leechers did not finish or a copy differs")
+    return {"summary": summary, "peers": results}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a swarm of peers on loopback and report completion metrics")
+    parser.add_argument("--peers", type=int, default=6)
+    parser.add_argument("--seeds", type=int, default=1)
+    parser.add_argument("--size", type=int, default=10*2**20, help="file size in bytes")
+    parser.add_argument("--piece-size", type=int, default=16384)
+    parser.add_argument("--file-name", default="bench.bin")
+    parser.add_argument("--content", choices=["random", "text"], default="random", help="random data does not compress, text compresses about 3x")
+    parser.add_argument("--preferred", type=int, default=2, help="NumberOfPreferredNeighbors")
+    parser.add_argument("--unchoke", type=int, default=1, help="UnchokingInterval in seconds")
+    parser.add_argument("--optimistic-unchoke", type=int, default=2, help="OptimisticUnchokingInterval in seconds")
+    parser.add_argument("--common", action="append", default=[], help="extra Common.cfg line such as 'RequestPipelineDepth 5', repeatable")
+    parser.add_argument("--engine", choices=["threaded", "asyncio", "mixed"], default="threaded")
+    parser.add_argument("--latency", type=float, default=0, help="one way delay in milliseconds added by the proxy")
+    parser.add_argument("--bandwidth", default="0", help="bytes per second per connection and direction through a peer's proxy, 0 for unlimited. "
+                        "A comma separated list is handed out to the peers in turn")
+    parser.add_argument("--seed-uplink", type=int, default=0, help="bytes per second each seed sends in total over all of its connections, 0 for unlimited")
+    parser.add_argument("--gap", type=float, default=0.3, help="seconds between starting consecutive peers")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds before unfinished peers are killed")
+    parser.add_argument("--no-manifest", action="store_true", help="do not give the peers a piece manifest")
+    parser.add_argument("--restart", type=float, default=0, help="kill the last leecher once it has this fraction of the pieces and start it again, 0 for never")
+    parser.add_argument("--restart-delay", type=float, default=1, help="seconds the killed leecher stays down")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory with the peers' logs")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="swarm_bench_")
+    proxy = None
+    try:
+        peer_ids, peer_dirs, source, proxy = setup_swarm(args, workdir)
+        started, usage, restart = run_swarm(args, peer_ids, peer_dirs)
+        results = report(args, peer_ids, peer_dirs, source, started, usage, restart)
+        if args.json:
+            with open(args.json, "w") as file:
+                json.dump(results, file, indent=2)
+    finally:
+        if proxy is not None:
+            proxy.stop()
+        if args.keep:
+            print(f"working directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if results["summary"]["all_verified"] else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from peerProcess import PeerProcess, PeerInfo
+
+# Measures how fast a seeder can push every piece of a file to one neighbor over loopback.
+# The legacy path reproduces what package_piece used to do for each request (exists check,
+# open, seek, read, prepend the index, concatenate the header, sendall) and is compared
+# against PeerProcess.send_piece.
+
+def drain(conn, total):
+    buffer = bytearray(1 << 20)
+    view = memoryview(buffer)
+    received = 0
+    while received < total:
+        n = conn.recv_into(view)
+        if n == 0:
+            break
+        received += n
+
+def legacy_send(conn, path, piece_index, piece_size):
+    if os.path.exists(path):
+        with open(path, "rb") as file_bytes:
+            file_bytes.seek(piece_index*piece_size)
+            msg_data = file_bytes.read(piece_size)
+    data = piece_index.to_bytes(4, byteorder='big') + msg_data
+    message = (len(data)+1).to_bytes(4, byteorder='big') + (7).to_bytes(1, byteorder='big') + data
+    conn.sendall(message)
+
+def run(label, send_all, file_size, num_pieces):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    sender = socket.create_connection(listener.getsockname())
+    receiver, _ = listener.accept()
+    total = file_size + 9*num_pieces
+    reader = threading.Thread(target=drain, args=(receiver, total))
+    reader.start()
+    start = time.perf_counter()
+    send_all(sender)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    for sock in (sender, receiver, listener):
+        sock.close()
+    print(f"{label:>10}: {total/elapsed/2**20:8.1f} MiB/s ({num_pieces/elapsed:9.0f} pieces/s)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Seeder upload throughput over loopback")
+    parser.add_argument("--size", type=int, default=64*2**20, help="file size in bytes")
+    parser.add_argument("--piece-size", type=int, default=16384)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="upload_bench_")
+    try:
+        os.chdir(workdir)
+        os.mkdir("peer_1")
+        path = f"{workdir}/peer_1/bench.bin"
+        with open(path, "wb") as file_bytes:
+            file_bytes.write(os.urandom(args.size))
+        peer = PeerProcess(1, "127.0.0.1", 0, True, 1, 5, 15, "bench.bin", args.size, args.piece_size, [])
+        num_pieces = peer.num_pieces
+
+        def legacy(sock):
+            for index in range(num_pieces):
+                legacy_send(sock, path, index, args.piece_size)
+
+        def current(sock):
+            peer.setup_neighbor(PeerInfo(2, "127.0.0.1", 0, '0'))
+            peer.register_socket(2, sock)
+            for index in range(num_pieces):
+                peer.send_piece(2, index)
+            peer.close_outbound(60)
+            peer.outbound.clear()
+
+        run("legacy", legacy, args.size, num_pieces)
+        run("send_piece", current, args.size, num_pieces)
+        peer.listening_socket.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
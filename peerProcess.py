@@ -1,12 +1,79 @@
-import sys
+import errno
 import os
+import argparse
+import asyncio
 import math
+import mmap
 import socket
 import select
 import time
 import logging
+import logging.handlers
+import queue
+import atexit
 import threading
 import random
+import bisect
+import heapq
+import itertools
+import collections
+import hashlib
+import concurrent.futures
+import json
+import zlib
+import multiprocessing
+import array
+
+#Reverses the bit order inside a byte, used to convert between wire bitfields and piece bitsets
+BIT_REVERSE = bytes(int(f"{byte:08b}"[::-1], 2) for byte in range(256))
+
+#Handshakes are the protocol name, 10 reserved bytes and the peer id. The last reserved byte holds
+#capability bits, which stay zero for peers that do not know about them.
+HANDSHAKE_PREFIX = "P2PFILESHARINGPROJ".encode('utf-8')
+CAPABILITY_COMPRESSION = 0x01
+CAPABILITY_BLOCKS = 0x02
+
+#Packets between a peer and its upload worker processes: the kind, the neighbor's peer id, then the payload.
+#The peer attaches a neighbor's socket, sends messages to it and stops the worker, the worker hands back
+#what the neighbor sent other than requests and cancels, the counters of the connection, closed connections,
+#and the pieces it served to the neighbor.
+WORKER_ATTACH = 0
+WORKER_SEND = 1
+WORKER_STOP = 2
+WORKER_RECEIVED = 0
+WORKER_REPORT = 1
+WORKER_CLOSED = 2
+WORKER_SERVED = 3
+#A packet is sent whole or not at all, and one larger than the socket's send buffer (about 208 KiB by
+#default on Linux) cannot be sent. Packets are kept below that and read with a buffer of the same size.
+WORKER_PACKET_LIMIT = 1 << 17
+
+def worker_packet(kind: int, peer_id: int, payload = b""):
+    if len(payload) + 5 > WORKER_PACKET_LIMIT:
+        raise ValueError(f"{len(payload)} bytes do not fit in a packet to or from an upload worker")
+    return kind.to_bytes(1, byteorder='big') + peer_id.to_bytes(4, byteorder='big') + payload
+
+#Turns the digits of bin() into one 0/1 byte per bit
+BINARY_DIGITS = bytes.maketrans(b"01", b"\x00\x01")
+
+def random_set_bit(mask: int):
+    #Uniformly chosen set bit: pick a rank, then halve the range with popcounts until one bit is left
+    rank = random.randrange(mask.bit_count())
+    position = 0
+    width = mask.bit_length()
+    while width > 1:
+        half = width // 2
+        lower = mask & ((1 << half) - 1)
+        lower_count = lower.bit_count()
+        if rank < lower_count:
+            mask = lower
+            width = half
+        else:
+            rank -= lower_count
+            mask >>= half
+            position += half
+            width -= half
+    return position
 
 class PeerProcess():
     def __init__(self,
@@ -20,7 +87,15 @@ class PeerProcess():
                  file_name: str,
                  file_size: int,
                  piece_size: int,
-                 next_peers):
+                 next_peers,
+                 request_pipeline_depth: int = 1,
+                 endgame: bool = True,
+                 metrics_interval: int = 0,
+                 compression: bool = True,
+                 piece_cache_size: int = 64*2**20,
+                 block_size: int = 16384,
+                 super_seeding: bool = False,
+                 upload_workers: int = 0):
         self.id = id
         self.host_name = host_name
         self.port = port
@@ -31,6 +106,14 @@ class PeerProcess():
         self.file_name = file_name
         self.file_size = file_size
         self.piece_size = piece_size
+        self.request_pipeline_depth = max(1, request_pipeline_depth)
+        self.endgame = endgame
+        self.metrics_interval = metrics_interval
+        #Capabilities advertised in our handshakes, each connection uses the ones both sides advertised
+        self.capabilities = CAPABILITY_BLOCKS | (CAPABILITY_COMPRESSION if compression else 0)
+        if block_size <= 0:
+            raise ValueError("BlockSize must be positive")
+        self.block_size = block_size
         
         self.subdir = f"{os.getcwd()}/peer_{str(self.id)}"
         if not os.path.exists(self.subdir):
@@ -43,11 +126,28 @@ class PeerProcess():
         self.num_pieces = int(math.ceil(file_size/piece_size))
         self.num_pieces_held = 0
 
-        self.bitfield = self.initialize_bitfield(self.has_file)
-        self.full_bitfield = self.initialize_bitfield(True) #For easy comparison purposes
-        self.empty_bitfield = self.initialize_bitfield(False) #For easy comparison purposes
-        self.pieces = self.initialize_pieces(self.has_file, self.piece_size, self.num_pieces)
+        #Piece sets are kept as integer bitsets with piece i at bit i, so interest checks are whole-word operations
+        self.bitfield_length = math.ceil(self.num_pieces / 8)
+        self.full_mask = (1 << self.num_pieces) - 1
+        self.have_mask = self.full_mask if self.has_file else 0
+        #Pieces requested from some neighbor and not yet received
+        self.in_flight_mask = 0
+        #Pieces written to the store whose hash is still being checked
+        self.verifying_mask = 0
+        #Pieces being fetched block by block, and those of them with blocks nobody has been asked for yet.
+        #A partial piece only counts as in flight while some of its blocks are requested.
+        self.partial_pieces = dict()
+        self.partial_mask = 0
+        self.open_partial_mask = 0
+        self.blocks_per_piece = math.ceil(piece_size / block_size)
+        self.picker = PiecePicker(self.num_pieces)
+        self.piece_store = PieceStore(f"{self.subdir}/{self.file_name}", self.file_size, self.piece_size, self.has_file)
+        #Hot pieces are compressed once however many neighbors they are uploaded to
+        self.compressed_pieces = CompressedPieceCache(self.piece_store, piece_cache_size) if compression else None
         self.peers_with_whole_file = 0
+        #Neighbors counted in peers_with_whole_file. They stay counted after disconnecting, a peer never loses pieces,
+        #and this keeps one that reconnects from being counted twice.
+        self.finished_neighbors = set()
         if self.has_file:
             self.peers_with_whole_file += 1
             self.num_pieces_held = self.num_pieces
@@ -55,120 +155,349 @@ class PeerProcess():
         
         self.peers_info = dict()
         self.connections = dict()
+        #Set up by start_listening, it also dials neighbors again after their connection is lost
+        self.connection_manager = None
         #List form used for reading from sockets
         self.sockets_list = list()
         self.socket_lock = threading.Lock()
+        #Outgoing messages of each neighbor, written by that neighbor's own writer thread
+        self.outbound = dict()
+        #A neighbor with more than this many bytes still unsent is not served further pieces until it catches up
+        self.outbound_limit = 2 * self.request_pipeline_depth * (self.piece_size + 9)
         self.listening_socket = self.initialize_socket(host_name, port)
         
 
         self.neighbors_interested = list()
         self.neighbors_choking_me = list()
-        self.current_requests = list()
+        self.neighbors_unchoking_me = set()
+        #Maps each requested piece to the neighbor it was requested from
+        self.current_requests = dict()
+        #In endgame, the other neighbors each in-flight piece was also requested from
+        self.endgame_requests = dict()
+        self.endgame_started = False
+        #Super-seeding, only for a peer that starts with the whole file. Each neighbor is offered up to request_pipeline_depth
+        #pieces through have messages, and is offered another each time one of them has spread, that is once a neighbor
+        #has it that did not get it from us. Offers still open per neighbor, pieces offered to anyone, pieces that have spread,
+        #and who each piece was uploaded to.
+        self.super_seeding = super_seeding and self.has_file
+        self.superseed_offers = dict()
+        self.superseed_offered = 0
+        self.superseed_spread = 0
+        self.superseed_given = dict()
 
         # TODO: choking and unchoking
+        #Smoothed piece bytes per second received from and sent to each neighbor
         self.download_rates = dict()
+        self.upload_rates = dict()
+        self.rate_window = 2 * self.unchoke_int
         self.preferred_neighbors = set()
         self.optimistically_unchoked_peer = None
         self.unchoke_lock = threading.Lock()
         
 
-        self.timers = list()
+        #Protocol state is touched by the receive loop, the listener and the scheduler, one at a time
+        self.state_lock = threading.RLock()
+        self.scheduler = Scheduler(self.state_lock)
+        #Timeout task of each outstanding request, cancelled when the piece arrives
+        self.request_timeouts = dict()
+        #Same for each requested block, by piece and block index
+        self.block_timeouts = dict()
         
+        #Counters updated on the message paths, turned into a snapshot only when one is written
+        self.metrics = PeerMetrics()
+        self.metrics_path = f"{self.subdir}/metrics.json"
+        #When each in-flight piece was first requested, for the request latency histogram
+        self.request_times = dict()
+
+        #Receive framing state of each neighbor, and which neighbor each socket belongs to
         self.peer_buffers = dict()
-        self.peers_next_length = dict()
+        self.socket_peers = dict()
+        exponent = int(math.ceil(math.log2((self.piece_size + 4 + 4 + 1)))) #For going to nearest power of 2 for buffer
+        self.max_msg_size = 2**(exponent+2) #Giving extra space for buffer
+
+        #A seed can hand its connections to upload worker processes so serving requests is not held to one core.
+        #Choking, haves and every other message are still handled here, the workers only serve pieces and blocks.
+        self.upload_workers = list()
+        self.worker_channels = dict()
+        #The seed's bitfield goes to each neighbor through its worker in a single packet
+        workers_ignored = upload_workers > 0 and self.has_file and self.bitfield_length + 10 > WORKER_PACKET_LIMIT
+        if upload_workers > 0 and self.has_file and not workers_ignored:
+            #Each worker has a cache of its own, with an equal share of the budget
+            cache_budget = piece_cache_size // upload_workers
+            for _ in range(upload_workers):
+                worker = UploadWorker(self, compression, cache_budget)
+                self.upload_workers.append(worker)
+                self.worker_channels[worker.channel.fileno()] = worker
+                self.sockets_list.append(worker.channel)
 
+        #Records are handed to a queue and formatted and written on the listener's thread, so the threads
+        #handling messages only pay for creating the record. Per-message lines use %-style arguments
+        #so their text is only built there too.
+        log_queue = queue.SimpleQueue()
+        file_handler = BatchedFileHandler(f'{os.getcwd()}/log_peer_{self.id}.log')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s : %(message)s'))
+        self.log_listener = BatchingQueueListener(log_queue, file_handler)
+        #The format only uses the time and the message, skip looking up the caller, thread and process of every record
+        logging._srcfile = None
+        logging.logThreads = False
+        logging.logProcesses = False
+        logging.logMultiprocessing = False
         logging.basicConfig(level=logging.INFO,  # Set the log level
-                    format='%(asctime)s : %(message)s',  # Set the log format
-                    handlers=[logging.FileHandler(f'{os.getcwd()}/log_peer_{self.id}.log'])
+                    handlers=[DeferredQueueHandler(log_queue)])
+        self.log_listener.start()
+        #Stopping the listener writes out whatever is still queued, however the process exits
+        atexit.register(self.log_listener.stop)
+        if workers_ignored:
+            logging.info(f"Peer {self.id} ignores UploadWorkers, a bitfield of {self.bitfield_length} bytes does not fit in a packet to an upload worker")
+
+        #Hashing releases the GIL, so a thread pool checks pieces on every core without blocking the socket loop
+        self.hash_pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        self.manifest_path = f"{os.getcwd()}/{self.file_name}.manifest"
+        #Whether the file was already on disk and its pieces have to be checked before they are trusted
+        self.verify_existing = self.piece_store.existed
+        self.manifest = self.load_manifest()
+        self.checkpoint = PieceCheckpoint(f"{self.subdir}/{self.file_name}.checkpoint", self.piece_size, self.file_size)
+        self.restore_existing_pieces()
         
-    def start_listening(self):
-        self.listener_thread = threading.Thread(target=self.wait_for_connection, daemon=True)
-        self.listener_thread.start()
+    def load_manifest(self):
+        #The seed writes the manifest the first time it starts, other peers use it when it has been copied next to their config
+        if os.path.exists(self.manifest_path):
+            manifest = PieceManifest.load(self.manifest_path)
+            if manifest.piece_size != self.piece_size or manifest.file_size != self.file_size:
+                raise RuntimeError(f"Manifest {self.manifest_path} does not match the file described in Common.cfg")
+            return manifest
+        if self.has_file:
+            manifest = PieceManifest.build(self.piece_store, self.hash_pool)
+            manifest.write(self.manifest_path)
+            logging.info(f"Peer {self.id} wrote the piece manifest {self.manifest_path}")
+            #Built from this very file, there is nothing left to verify
+            self.verify_existing = False
+            return manifest
+        logging.info(f"Peer {self.id} has no piece manifest, received pieces will not be verified")
+        return None
+
+    def restore_existing_pieces(self):
+        #Works out which pieces of a file already on disk can be trusted. A seed must match the manifest completely.
+        #A leecher takes the pieces its checkpoint lists, or every piece when there is only a manifest to go by,
+        #and with a manifest keeps only the ones whose hashes match, checked in parallel.
+        if self.has_file:
+            if self.manifest is not None and self.verify_existing:
+                good_mask = self.manifest.check_pieces(self.piece_store, self.hash_pool, self.full_mask)
+                if good_mask != self.full_mask:
+                    raise RuntimeError(f"Peer is marked as having file {self.file_name} yet {(self.full_mask & ~good_mask).bit_count()} of its pieces do not match the manifest.")
+            return
+        candidates = self.checkpoint.load() if self.verify_existing else 0
+        if self.verify_existing and not self.checkpoint.existed and self.manifest is not None:
+            candidates = self.full_mask
+        candidates &= self.full_mask
+        if self.manifest is not None and candidates:
+            candidates = self.manifest.check_pieces(self.piece_store, self.hash_pool, candidates)
+        self.have_mask = candidates
+        self.num_pieces_held = candidates.bit_count()
+        #Start the record over with just what survived
+        self.checkpoint.rewrite(candidates)
+        if self.num_pieces_held > 0:
+            logging.info(f"Peer {self.id} resumed with {self.num_pieces_held} pieces already on disk")
+        self.check_for_completion()
+
+    def dispatch(self, function, *args):
+        #Runs work handed back from a pool thread against the protocol state
+        with self.state_lock:
+            try:
+                function(*args)
+            except (OSError, ValueError) as e:
+                logging.info(f"Error: {e}")
+
+    def start_listening(self, prev_peers):
+        self.connection_manager = ConnectionManager(self, prev_peers, self.next_peers)
+        self.connection_manager.start()
         
         
-    def initialize_bitfield(self, has_file: bool):
-        length = math.ceil(self.num_pieces / 8) * 8
-        remainder = (8 - (self.num_pieces % 8)) % 8
-        if has_file:
-            # Set all bits to one except remainder
-            bitfield = '1'*(length-remainder) + '0'*(remainder)
-        else:
-            bitfield = '0'*(length)
-        bitfield_int = int(bitfield,2)
-        return bytearray(bitfield_int.to_bytes(length // 8, byteorder='big'))
-    
-    def initialize_pieces(self, has_file: bool, piece_size: int, num_pieces: int):
-        return dict({i: has_file for i in range(num_pieces)})
+    def make_bitfield(self, mask: int):
+        #Wire format puts piece 0 in the high bit of the first byte
+        return bytearray(mask.to_bytes(self.bitfield_length, byteorder='little').translate(BIT_REVERSE))
+
+    def read_bitfield(self, bitfield):
+        return int.from_bytes(bytes(bitfield).translate(BIT_REVERSE), byteorder='little') & self.full_mask
 
     def initialize_socket(self, host_name: str, port: int):
         with self.socket_lock:
             try:
                 curr_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                #A restarted peer has to get its port back while old connections are still in TIME_WAIT
+                curr_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 curr_socket.bind((host_name, port))
-                curr_socket.listen(len(self.next_peers))
+                #Every other peer may be dialing at once
+                curr_socket.listen(socket.SOMAXCONN)
             except ConnectionError as e:
                 logging.info(f"Error: {e}")
             return curr_socket
     
-    def make_handshake_header(self, peer_id: int):
-        initial_header = "P2PFILESHARINGPROJ".encode('utf-8')
-        zero_bytes = bytearray(10)
+    def make_handshake_header(self, peer_id: int, capabilities: int = 0):
+        initial_header = HANDSHAKE_PREFIX
+        zero_bytes = bytearray(9) + capabilities.to_bytes(1, byteorder = 'big')
         identifier = peer_id.to_bytes(4, byteorder = 'big')
         full_header = initial_header + zero_bytes + identifier
         return full_header
 
-    def add_peer(self, peer):
+    def read_handshake_header(self, header):
+        #Returns the peer id and capabilities. The reserved bytes are not compared, so a peer advertising
+        #capabilities we do not know is still accepted.
+        if len(header) != 32 or header[:len(HANDSHAKE_PREFIX)] != HANDSHAKE_PREFIX:
+            raise ValueError("Header is not a handshake of this protocol")
+        return int.from_bytes(header[-4:], "big"), header[-5]
+
+    def setup_neighbor(self, peer, capabilities: int = 0):
         self.peers_info[peer.peer_id] = peer
-        self.peers_info[peer.peer_id].bitfield = self.initialize_bitfield(False)
-        self.peers_info[peer.peer_id].interesting_pieces = list()
-        self.download_rates[peer.peer_id] = 0
-        
+        self.peers_info[peer.peer_id].capabilities = capabilities
+        self.peers_info[peer.peer_id].have_mask = 0
+        self.peers_info[peer.peer_id].announced_mask = 0
+        self.peers_info[peer.peer_id].bad_pieces = 0
+        self.peers_info[peer.peer_id].interested_in_them = False
+        self.peers_info[peer.peer_id].interested_in_me = False
+        self.peers_info[peer.peer_id].outstanding_requests = set()
+        self.peers_info[peer.peer_id].outstanding_blocks = set()
+        self.download_rates[peer.peer_id] = RateEstimator(self.rate_window)
+        self.upload_rates[peer.peer_id] = RateEstimator(self.rate_window)
+        self.metrics.add_neighbor(peer.peer_id)
+
+    def register_socket(self, peer_id: int, conn):
+        #Returns whether the socket is read here, it is not once a worker process serves the connection
+        if self.upload_workers:
+            worker = self.upload_workers[len(self.connections) % len(self.upload_workers)]
+            self.connections[peer_id] = conn
+            self.outbound[peer_id] = worker.attach(peer_id, conn, self.peers_info[peer_id].capabilities)
+            return False
+        self.connections[peer_id] = conn
+        self.socket_peers[conn.fileno()] = peer_id
+        self.peer_buffers[peer_id] = MessageFramer(self.max_msg_size)
+        self.outbound[peer_id] = OutboundQueue(peer_id, conn, self.piece_store, self.upload_rates[peer_id], self.piece_compressor(peer_id))
+        return True
+
+    def receive_from(self, sock):
+        #Handles a socket the receive loop found readable
+        worker = self.worker_channels.get(sock.fileno())
+        if worker is not None:
+            worker.receive()
+            return
+        peer_id = self.socket_peers[sock.fileno()]
+        framer = self.peer_buffers[peer_id]
         try:
-            self.connections[peer.peer_id] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.connections[peer.peer_id].connect((peer.host_name, peer.port_num))
+            # Receive straight into the neighbor's buffer
+            try:
+                received = framer.receive(sock)
+            except ConnectionResetError:
+                received = 0
+            if received == 0:
+                # Neighbor closed the connection or went away
+                with self.state_lock:
+                    self.drop_neighbor(peer_id)
+                return
+            self.metrics.neighbors[peer_id].bytes_received += received
+            #Read messages, each one is a view into the buffer that is only valid during read_message
+            for message in framer.messages():
+                with self.state_lock:
+                    self.read_message(peer_id, message)
+
+        except RuntimeError as e:
+            logging.info(f"Error: {e}")
+
+    def piece_compressor(self, peer_id: int):
+        #Pieces only go out compressed to neighbors whose handshake said they can inflate them
+        if self.peers_info[peer_id].capabilities & CAPABILITY_COMPRESSION:
+            return self.compressed_pieces
+        return None
+
+    def close_outbound(self, timeout: float):
+        #Gives every writer a chance to send what is still queued, such as the last have messages
+        deadline = time.monotonic() + timeout
+        for peer_id, outbound in self.outbound.items():
+            outbound.close(max(0, deadline - time.monotonic()))
+            logging.info(f"Peer {self.id} sent {outbound.sent.pieces_sent} pieces and {outbound.sent.messages_sent} messages to Peer {peer_id} in {outbound.sent.send_calls} send calls")
+
+    def unsent_bytes(self, peer_id: int):
+        return self.outbound[peer_id].queued_bytes
+
+    def upload_backlogged(self, peer_id: int):
+        return self.unsent_bytes(peer_id) > self.outbound_limit
+
+    def establish_connection(self, peer, conn, outbound: bool, capabilities: int):
+        #Runs with state_lock held once the handshake with a new neighbor is complete
+        if outbound:
             logging.info(f"Peer {self.id} makes a connection to Peer {peer.peer_id}")
-            self.connections[peer.peer_id].send(self.make_handshake_header(self.id))
-            answer = self.connections[peer.peer_id].recv(1024)
-            if answer != self.make_handshake_header(peer.peer_id):
-                raise ConnectionError("Unexpected header, something with the connection has failed")
-            if self.bitfield != self.empty_bitfield:
-                self.send_message(peer.peer_id, 5, self.bitfield)
+        else:
+            logging.info(f"Peer {self.id} is connected from Peer {peer.peer_id}")
+        self.setup_neighbor(peer, capabilities)
+        conn.setblocking(True)
+        if self.register_socket(peer.peer_id, conn):
+            self.sockets_list.append(conn)
+        self.resume_unchoke_timers()
+        self.perform_unchoking()
+        self.announce_pieces(peer.peer_id)
+
+    def drop_neighbor(self, peer_id: int):
+        #Runs with state_lock held once a neighbor's connection is gone. Everything kept about the neighbor is
+        #dropped and its requests and blocks go back to the others, as when it chokes us, so that a neighbor
+        #that restarts is set up from scratch when it connects again. It is dialed again until it does.
+        neighbor = self.peers_info.get(peer_id)
+        if neighbor is None:
+            return
+        logging.info(f"Peer {self.id} lost the connection to Peer {peer_id}")
+        self.neighbors_unchoking_me.discard(peer_id)
+        if peer_id in self.neighbors_interested:
+            self.neighbors_interested.remove(peer_id)
+        self.neighbors_choking_me = [neighbor_id for neighbor_id in self.neighbors_choking_me if neighbor_id != peer_id]
+        was_unchoked = peer_id in self.preferred_neighbors or peer_id == self.optimistically_unchoked_peer
+        self.preferred_neighbors.discard(peer_id)
+        if self.optimistically_unchoked_peer == peer_id:
+            self.optimistically_unchoked_peer = None
+        for piece_index in list(neighbor.outstanding_requests):
+            if self.current_requests.get(piece_index) == peer_id:
+                self.release_request(piece_index)
+            elif piece_index in self.endgame_requests:
+                self.endgame_requests[piece_index].discard(peer_id)
+        neighbor.outstanding_requests.clear()
+        self.release_neighbor_blocks(peer_id)
+        self.superseed_offers.pop(peer_id, None)
+        for given in self.superseed_given.values():
+            given.discard(peer_id)
+        self.picker.remove_availability(neighbor.have_mask)
+        del self.peers_info[peer_id]
+        del self.download_rates[peer_id]
+        del self.upload_rates[peer_id]
+        self.close_connection(peer_id)
+        self.redial(peer_id)
+        self.update_all_interest()
+        for neighbor_id in list(self.neighbors_unchoking_me):
+            self.find_and_request(neighbor_id)
+        if was_unchoked:
             self.perform_unchoking()
-        except ConnectionError as e:
-            logging.info(f"Error: {e}")
-            del self.peers_info[peer.peer_id]
-            del self.connections[peer.peer_id]
-            return None
 
-    def wait_for_connection(self):
-        with self.socket_lock:
-            while len(self.next_peers) > 0:
-                conn, addr = self.listening_socket.accept()
-                try:
-                    header = conn.recv(1024)
-                    byte_conn_id = header[-4:]
-                    conn_id = int.from_bytes(byte_conn_id, "big")
-                    if conn_id != self.next_peers[0].peer_id:
-                        raise ConnectionError("Header has an incorrect peer id")
-                    curr_peer = self.next_peers[0]
-                    logging.info(f"Peer {self.id} is connected from Peer {curr_peer.peer_id}")
-                    self.peers_info[curr_peer.peer_id] = curr_peer
-                    self.peers_info[curr_peer.peer_id].bitfield = self.initialize_bitfield(False)
-                    self.peers_info[curr_peer.peer_id].interesting_pieces = list()
-                    self.sockets_list.append(conn)
-                    self.connections[curr_peer.peer_id] = conn
-                    self.peer_buffers[curr_peer.peer_id] = bytearray()
-                    self.peers_next_length[curr_peer.peer_id] = 0
-                    self.download_rates[curr_peer.peer_id] = 0
-                    self.next_peers.remove(curr_peer)
-                    self.connections[curr_peer.peer_id].send(self.make_handshake_header(self.id))
-                    self.perform_unchoking()
-                    if self.bitfield != self.empty_bitfield:
-                        self.send_message(curr_peer.peer_id, 5, self.bitfield)
-                except ConnectionError as e:
-                    logging.info(f"Error: {e}")
+    def close_connection(self, peer_id: int):
+        conn = self.connections.pop(peer_id)
+        if self.socket_peers.pop(conn.fileno(), None) is not None:
+            self.sockets_list.remove(conn)
+        self.peer_buffers.pop(peer_id, None)
+        #Shut down first so a writer blocked on the socket gives up before it is closed
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.outbound.pop(peer_id).abort()
+        conn.close()
 
-    def send_message(self, peer_id: int, msg_type: int, data = None):
+    def redial(self, peer_id: int):
+        if self.connection_manager is not None:
+            self.connection_manager.redial(peer_id)
+
+    def announce_pieces(self, peer_id: int):
+        #A super-seed only tells a new neighbor about the piece it offers it
+        if self.super_seeding:
+            self.superseed_offer(peer_id)
+        elif self.have_mask != 0:
+            self.send_message(peer_id, 5, self.make_bitfield(self.have_mask))
+
+    def encode_message(self, msg_type: int, data = None):
         if data:
             send_length = (len(data)+1).to_bytes(4, byteorder='big')
         else:
@@ -177,12 +506,38 @@ class PeerProcess():
         message = send_length + send_type
         if data:
             message = message + data
-        self.connections[peer_id].sendall(message)
+        return message
+
+    def encode_piece_header(self, piece_index: int, piece_length: int):
+        return (piece_length + 5).to_bytes(4, byteorder='big') + (7).to_bytes(1, byteorder='big') + piece_index.to_bytes(4, byteorder='big')
+
+    def encode_block_header(self, piece_index: int, offset: int, length: int):
+        return (length + 9).to_bytes(4, byteorder='big') + (11).to_bytes(1, byteorder='big') + piece_index.to_bytes(4, byteorder='big') + offset.to_bytes(4, byteorder='big')
+
+    def send_message(self, peer_id: int, msg_type: int, data = None):
+        #Only queued here, so a neighbor that reads slowly never blocks the thread handling messages
+        if msg_type <= 1:
+            self.metrics.count_choke_sent(peer_id, msg_type)
+        self.outbound[peer_id].put_message(self.encode_message(msg_type, data))
+
+    def send_piece(self, peer_id: int, piece_index: int):
+        #Queued by index, the writer sends the payload straight from the store
+        self.outbound[peer_id].put_piece(piece_index)
+
+    def send_block(self, peer_id: int, piece_index: int, offset: int, length: int):
+        self.outbound[peer_id].put_block(piece_index, offset, length)
+
+    def encode_block_request(self, piece_index: int, offset: int, length: int):
+        #Payload of block requests and block cancels
+        return piece_index.to_bytes(4, byteorder='big') + offset.to_bytes(4, byteorder='big') + length.to_bytes(4, byteorder='big')
 
     def read_message(self, peer_id: int, message):
         #Kill line: If you want to test the program up to a certain point and then have it cleanly stop,
         #Copy the following line at the end of said process
         #self.peers_with_whole_file = len(self.connections) +1
+        if peer_id not in self.peers_info:
+            #Handed over after the neighbor was dropped, such as by an upload worker
+            return
         msg_length = int.from_bytes(message[0:4], byteorder='big')
         msg_type = int.from_bytes(message[4:5], byteorder='big')
         msg_data = None
@@ -194,59 +549,72 @@ class PeerProcess():
             match msg_type:
                 case 0:
                     #Message is choke
-                    logging.info(f"Peer {self.id} is choked by {peer_id}")
+                    logging.info("Peer %s is choked by %s", self.id, peer_id)
+                    self.metrics.neighbors[peer_id].chokes_received += 1
                     self.neighbors_choking_me.append(peer_id)
-                    
+                    self.neighbors_unchoking_me.discard(peer_id)
+                    #Requests still queued with this neighbor will not be answered, hand them to the others
+                    for piece_index in list(self.peers_info[peer_id].outstanding_requests):
+                        self.restore_interest(piece_index, peer_id)
+                    if self.peers_info[peer_id].outstanding_blocks:
+                        self.release_neighbor_blocks(peer_id)
+                        self.update_all_interest()
+                        for neighbor_id in list(self.neighbors_unchoking_me):
+                            self.find_and_request(neighbor_id)
 
                 case 1:
                     #Message is unchoke
                     if peer_id in self.neighbors_choking_me:
                         self.neighbors_choking_me.remove(peer_id)
-                    logging.info(f"Peer {self.id} is unchoked by {peer_id}")
-                    if len(self.peers_info[peer_id].interesting_pieces) != 0:
-                        self.find_and_request(peer_id)
+                    self.neighbors_unchoking_me.add(peer_id)
+                    logging.info("Peer %s is unchoked by %s", self.id, peer_id)
+                    self.metrics.neighbors[peer_id].unchokes_received += 1
+                    self.find_and_request(peer_id)
                 case 2:
                     #Message is interested
-                    logging.info(f"Peer {self.id} received the \'interested\' message from Peer {peer_id}")
+                    logging.info("Peer %s received the 'interested' message from Peer %s", self.id, peer_id)
                     self.peers_info[peer_id].interested_in_me = True
                     self.neighbors_interested.append(peer_id)
                 case 3:
                     #Message is not interested
-                    logging.info(f"Peer {self.id} received the \'not interested\' message from Peer {peer_id}")
+                    logging.info("Peer %s received the 'not interested' message from Peer %s", self.id, peer_id)
                     self.peers_info[peer_id].interested_in_me = False
-                    self.neighbors_interested.remove(peer_id)
+                    if peer_id in self.neighbors_interested:
+                        self.neighbors_interested.remove(peer_id)
                 case 4:
                     #Message is have
                     piece_index = int.from_bytes(msg_data, byteorder='big')
-                    logging.info(f"Peer {self.id} received the \'have\' message from Peer {peer_id} for the piece {piece_index}")
-                    piece_byte = piece_index // 8
-                    piece_bit = piece_index % 8
-                    tick_mark = (1 << (7 - piece_bit))
-                    self.peers_info[peer_id].bitfield[piece_byte] =  self.peers_info[peer_id].bitfield[piece_byte] | tick_mark
-                    if self.peers_info[peer_id].bitfield == self.full_bitfield:
-                        self.peers_with_whole_file += 1
-                    if not bool(self.bitfield[piece_byte] & tick_mark) and piece_index not in self.current_requests:
-                        uninterested_before = len(self.peers_info[peer_id].interesting_pieces) == 0
-                        self.peers_info[peer_id].interesting_pieces.append(piece_index)
-                        interested_now = len(self.peers_info[peer_id].interesting_pieces) != 0
-                        if uninterested_before and interested_now:
-                            self.send_message(peer_id, 2)
+                    logging.info("Peer %s received the 'have' message from Peer %s for the piece %s", self.id, peer_id, piece_index)
+                    if piece_index >= self.num_pieces:
+                        raise ValueError(f"Peer {peer_id} announced piece {piece_index} which is outside of the file")
+                    neighbor = self.peers_info[peer_id]
+                    tick_mark = 1 << piece_index
+                    if not neighbor.have_mask & tick_mark:
+                        self.picker.add_piece(piece_index)
+                        neighbor.have_mask |= tick_mark
+                        if neighbor.have_mask == self.full_mask:
+                            self.count_finished_neighbor(peer_id)
+                        if self.super_seeding:
+                            self.superseed_check(piece_index)
+                        self.update_interest(peer_id)
+                        self.find_and_request(peer_id)
                 case 5:
                     #Message is bitfield
-                    if len(msg_data) != len(self.peers_info[peer_id].bitfield):
+                    if len(msg_data) != self.bitfield_length:
                         raise ValueError("Provided Bitfield is Incorrect Size")
-                    self.peers_info[peer_id].bitfield = msg_data
-                    if msg_data == self.full_bitfield:
-                        self.peers_with_whole_file += 1
-                    interested = False
-                    for byte in range(len(msg_data)):
-                        for bit in range(8):
-                            in_msg_data = bool(msg_data[byte] & (1 << (7 - bit)))
-                            out_bitfield = not bool(self.bitfield[byte] & (1 << (7 - bit)))
-                            if in_msg_data and out_bitfield:
-                                tick_mark = (1 << (7 - bit))
-                                self.peers_info[peer_id].interesting_pieces.append(((8*byte)+bit))
-                    if len(self.peers_info[peer_id].interesting_pieces) > 0:
+                    neighbor = self.peers_info[peer_id]
+                    received_mask = self.read_bitfield(msg_data)
+                    new_pieces = received_mask & ~neighbor.have_mask
+                    self.picker.add_availability(new_pieces)
+                    neighbor.have_mask |= received_mask
+                    if received_mask == self.full_mask:
+                        self.count_finished_neighbor(peer_id)
+                    while self.super_seeding and new_pieces:
+                        lowest = new_pieces & -new_pieces
+                        new_pieces ^= lowest
+                        self.superseed_check(lowest.bit_length() - 1)
+                    neighbor.interested_in_them = self.interesting_mask(neighbor) != 0
+                    if neighbor.interested_in_them:
                         self.send_message(peer_id, 2)
                         self.find_and_request(peer_id)
                     else:
@@ -258,41 +626,115 @@ class PeerProcess():
                         return
                     try:
                         piece_index = int.from_bytes(msg_data, byteorder="big")
-                        piece_byte = piece_index // 8
-                        piece_bit = piece_index % 8
-                        tick_mark = 1 << (7 - piece_bit)
-                        if not bool(self.bitfield[piece_byte] & tick_mark):
+                        if not (self.have_mask >> piece_index) & 1:
                             raise ValueError("Requested piece is not in this peer")
-                        self.send_message(peer_id, 7, self.package_piece(piece_index)) 
+                        if self.upload_backlogged(peer_id):
+                            #The neighbor re-requests the piece when its request times out
+                            logging.info("Peer %s skipped piece %s for Peer %s, %s bytes are still waiting to be sent to it", self.id, piece_index, peer_id, self.unsent_bytes(peer_id))
+                            return
+                        if self.super_seeding:
+                            self.superseed_given.setdefault(piece_index, set()).add(peer_id)
+                        self.send_piece(peer_id, piece_index)
                     except ValueError as e:
                         logging.info(f"Error: {e}")
                 case 7:
                     #Message is piece
                     piece_index = int.from_bytes(msg_data[0:4], byteorder="big")
-                    piece_byte = piece_index // 8
-                    piece_bit = piece_index % 8
-                    tick_mark = 1 << (7 - piece_bit)
-                    if bool(self.bitfield[piece_byte] & tick_mark):
+                    self.piece_store.piece_bounds(piece_index)
+                    tick_mark = 1 << piece_index
+                    if (self.have_mask | self.verifying_mask) & tick_mark:
                         #Just going to ignore and return, this is a rare but possible case when the piece is requested, times out, rerequested, and then the original times out
                         #It doesn't actually cause an issue, so we'll just ignore, and next timeout will recognize it's there
                         return
+                    if piece_index in self.partial_pieces:
+                        self.drop_partial(piece_index, peer_id)
                     piece_data = msg_data[4:]
-                    with open(f"{self.subdir}/partial_piece_{piece_index}_{self.file_name}", "wb") as file_bytes:
-                        file_bytes.write(piece_data)
-                    self.pieces[piece_index] = True
-                    self.num_pieces_held += 1
-                    self.update_download_rate(peer_id, len(piece_data))
-                    logging.info(f"Peer {self.id} has downloaded the piece {piece_index} from {peer_id}. Now the number of pieces it has is {self.num_pieces_held}")
-                    self.bitfield[piece_byte] = self.bitfield[piece_byte] | tick_mark
-                    self.check_for_completion()
-                    piece_index_in_bytes = bytes((piece_index).to_bytes(4, byteorder="big"))
-                    for peer in self.peers_info.values():
-                        self.send_message(peer.peer_id, 4, piece_index_in_bytes)
-                    if piece_index in self.current_requests:
-                        self.current_requests.remove(piece_index)
-                    self.remove_interest(piece_index)
-                    if len(self.peers_info[peer_id].interesting_pieces) != 0:
-                        self.find_and_request(peer_id)
+                    requested_at = self.request_times.pop(piece_index, None)
+                    if requested_at is not None:
+                        self.metrics.request_latency.observe(time.monotonic() - requested_at)
+                    self.metrics.neighbors[peer_id].pieces_received += 1
+                    self.piece_store.write_piece(piece_index, piece_data)
+                    self.cancel_duplicates(piece_index, peer_id)
+                    if self.manifest is None:
+                        self.accept_piece(peer_id, piece_index, len(piece_data))
+                        return
+                    #The piece is not announced until its hash has been checked off the receive thread
+                    self.verifying_mask |= tick_mark
+                    future = self.hash_pool.submit(self.manifest.check, self.piece_store, piece_index)
+                    future.add_done_callback(lambda done, peer_id=peer_id, piece_index=piece_index, piece_length=len(piece_data):
+                                             self.dispatch(self.piece_checked, peer_id, piece_index, piece_length, done.result()))
+                case 9:
+                    #Message is compressed piece, only sent by neighbors we advertised compression to
+                    piece_index = int.from_bytes(msg_data[0:4], byteorder="big")
+                    start, end = self.piece_store.piece_bounds(piece_index)
+                    tick_mark = 1 << piece_index
+                    if (self.have_mask | self.verifying_mask) & tick_mark:
+                        return
+                    if piece_index in self.partial_pieces:
+                        self.drop_partial(piece_index, peer_id)
+                    requested_at = self.request_times.pop(piece_index, None)
+                    if requested_at is not None:
+                        self.metrics.request_latency.observe(time.monotonic() - requested_at)
+                    self.metrics.neighbors[peer_id].pieces_received += 1
+                    self.metrics.neighbors[peer_id].compressed_pieces_received += 1
+                    self.cancel_duplicates(piece_index, peer_id)
+                    #Inflated, written and checked on the pool. The message is a view into the receive buffer, so it is copied first.
+                    self.verifying_mask |= tick_mark
+                    future = self.hash_pool.submit(self.store_compressed_piece, piece_index, bytes(msg_data[4:]))
+                    future.add_done_callback(lambda done, peer_id=peer_id, piece_index=piece_index, piece_length=end - start:
+                                             self.dispatch(self.piece_checked, peer_id, piece_index, piece_length, done.result()))
+                case 8:
+                    #Message is cancel, the neighbor got the piece or block from someone else during its endgame
+                    piece_index = int.from_bytes(msg_data[0:4], byteorder="big")
+                    if len(msg_data) == 12:
+                        offset = int.from_bytes(msg_data[4:8], byteorder="big")
+                        length = int.from_bytes(msg_data[8:12], byteorder="big")
+                        if self.cancel_block(peer_id, piece_index, offset, length):
+                            logging.info("Peer %s cancelled sending the block at %s of piece %s to Peer %s", self.id, offset, piece_index, peer_id)
+                    elif self.cancel_piece(peer_id, piece_index):
+                        logging.info("Peer %s cancelled sending piece %s to Peer %s", self.id, piece_index, peer_id)
+                case 10:
+                    #Message is block request, the piece index then the offset and length of the block within it
+                    if peer_id not in self.preferred_neighbors and peer_id != self.optimistically_unchoked_peer:
+                        return
+                    piece_index = int.from_bytes(msg_data[0:4], byteorder="big")
+                    offset = int.from_bytes(msg_data[4:8], byteorder="big")
+                    length = int.from_bytes(msg_data[8:12], byteorder="big")
+                    start, end = self.piece_store.piece_bounds(piece_index)
+                    if not (self.have_mask >> piece_index) & 1 or length == 0 or offset + length > end - start:
+                        raise ValueError(f"Requested block at {offset} of piece {piece_index} is not in this peer")
+                    if self.upload_backlogged(peer_id):
+                        logging.info("Peer %s skipped a block of piece %s for Peer %s, %s bytes are still waiting to be sent to it", self.id, piece_index, peer_id, self.unsent_bytes(peer_id))
+                        return
+                    if self.super_seeding:
+                        self.superseed_given.setdefault(piece_index, set()).add(peer_id)
+                    self.send_block(peer_id, piece_index, offset, length)
+                case 11:
+                    #Message is block, the piece index and offset followed by the data
+                    piece_index = int.from_bytes(msg_data[0:4], byteorder="big")
+                    offset = int.from_bytes(msg_data[4:8], byteorder="big")
+                    partial = self.partial_pieces.get(piece_index)
+                    if partial is None or offset % self.block_size:
+                        #Arrived after the piece was completed or taken whole from another neighbor
+                        return
+                    block_index = offset // self.block_size
+                    if block_index >= partial.num_blocks or (partial.received >> block_index) & 1:
+                        return
+                    block_data = msg_data[8:]
+                    if len(block_data) != self.block_bounds(piece_index, block_index)[1]:
+                        raise ValueError(f"Block at {offset} of piece {piece_index} from {peer_id} has the wrong length")
+                    self.piece_store.write_block(piece_index, offset, block_data)
+                    partial.received |= 1 << block_index
+                    partial.senders.add(peer_id)
+                    self.metrics.neighbors[peer_id].blocks_received += 1
+                    self.update_download_rate(peer_id, len(block_data))
+                    self.release_block(piece_index, block_index, peer_id)
+                    if partial.complete():
+                        self.assemble_piece(piece_index, peer_id)
+                    else:
+                        self.refresh_partial(piece_index)
+                    #Block requests are freed as each block arrives, so the pipeline is topped up right away
+                    self.find_and_request(peer_id)
 
                 case _:
                     #Message is unexpected value
@@ -300,96 +742,526 @@ class PeerProcess():
         except ValueError as e:
             logging.info(f"Error: {e}")
 
+    def store_compressed_piece(self, piece_index: int, compressed: bytes):
+        #Runs on the pool. Inflating stops at the piece length, so a corrupt stream cannot grow past it.
+        start, end = self.piece_store.piece_bounds(piece_index)
+        try:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(compressed, end - start)
+            if len(data) != end - start or not decompressor.eof:
+                raise zlib.error(f"inflates to {len(data)} bytes or more instead of {end - start}")
+        except zlib.error as e:
+            logging.info(f"Error: Compressed piece {piece_index} is corrupt, {e}")
+            return False
+        self.piece_store.write_piece(piece_index, data)
+        if self.manifest is not None and not self.manifest.check(self.piece_store, piece_index):
+            return False
+        if self.compressed_pieces is not None:
+            self.compressed_pieces.put(piece_index, compressed)
+        return True
+
+    def piece_checked(self, peer_id: int, piece_index: int, piece_length: int, ok: bool, senders = None):
+        self.verifying_mask &= ~(1 << piece_index)
+        if ok:
+            self.accept_piece(peer_id, piece_index, piece_length)
+            return
+        logging.info(f"Error: Piece {piece_index} from Peer {peer_id} is corrupt or does not match the manifest and was discarded")
+        #Ask other neighbors for the piece first, the ones that sent it are only asked again after a request timeout.
+        #A piece put together from blocks counts against every neighbor that sent some of them.
+        for sender_id in senders or (peer_id,):
+            if sender_id in self.peers_info:
+                self.peers_info[sender_id].bad_pieces |= 1 << piece_index
+                self.scheduler.call_later(self.unchoke_int*4, self.forgive_piece, sender_id, piece_index)
+        self.release_request(piece_index)
+        self.update_all_interest()
+        for neighbor_id in list(self.neighbors_unchoking_me):
+            self.find_and_request(neighbor_id)
+
+    def forgive_piece(self, peer_id: int, piece_index: int):
+        if peer_id not in self.peers_info:
+            return
+        self.peers_info[peer_id].bad_pieces &= ~(1 << piece_index)
+        self.update_interest(peer_id)
+        self.find_and_request(peer_id)
+
+    def release_request(self, piece_index: int):
+        #Frees the request slot of whoever the piece was requested from, which may not be the
+        #neighbor that sent it if the request was reassigned after a choke
+        requested_from = self.current_requests.pop(piece_index, None)
+        if requested_from is not None:
+            self.peers_info[requested_from].outstanding_requests.discard(piece_index)
+        for other_id in self.endgame_requests.pop(piece_index, ()):
+            self.peers_info[other_id].outstanding_requests.discard(piece_index)
+        self.cancel_request_timeout(piece_index)
+        self.request_times.pop(piece_index, None)
+        self.in_flight_mask &= ~(1 << piece_index)
+        if piece_index in self.partial_pieces:
+            #Some of its blocks may still be requested from neighbors fetching blocks
+            self.refresh_partial(piece_index)
+        return requested_from
+
+    def accept_piece(self, peer_id: int, piece_index: int, piece_length: int):
+        tick_mark = 1 << piece_index
+        self.num_pieces_held += 1
+        #The neighbor may have been dropped while the piece was being checked
+        if peer_id in self.download_rates:
+            self.update_download_rate(peer_id, piece_length)
+        logging.info("Peer %s has downloaded the piece %s from %s. Now the number of pieces it has is %s", self.id, piece_index, peer_id, self.num_pieces_held)
+        self.have_mask |= tick_mark
+        self.checkpoint.record(piece_index)
+        self.check_for_completion()
+        piece_index_in_bytes = bytes((piece_index).to_bytes(4, byteorder="big"))
+        for peer in self.peers_info.values():
+            self.send_message(peer.peer_id, 4, piece_index_in_bytes)
+        requested_from = self.release_request(piece_index)
+        self.update_all_interest()
+        if self.endgame_started:
+            #Cancelled duplicates may have left any neighbor with free request slots
+            for neighbor_id in list(self.neighbors_unchoking_me):
+                self.find_and_request(neighbor_id)
+            return
+        self.find_and_request(peer_id)
+        if requested_from is not None and requested_from != peer_id:
+            self.find_and_request(requested_from)
+
+    def superseed_offer(self, peer_id: int):
+        #Tops up the neighbor's offers with the rarest pieces it lacks that nobody has been offered yet, failing that
+        #ones that have not spread yet, and only then ones that have
+        neighbor = self.peers_info[peer_id]
+        offers = self.superseed_offers.setdefault(peer_id, set())
+        while len(offers) < self.request_pipeline_depth:
+            missing = self.full_mask & ~(neighbor.have_mask | neighbor.announced_mask)
+            for candidates in (missing & ~self.superseed_offered, missing & ~self.superseed_spread, missing):
+                if candidates:
+                    piece_index = self.picker.pick(candidates, self.num_pieces_held)
+                    break
+            else:
+                return
+            offers.add(piece_index)
+            self.superseed_offered |= 1 << piece_index
+            neighbor.announced_mask |= 1 << piece_index
+            self.send_message(peer_id, 4, (piece_index).to_bytes(4, byteorder="big"))
+
+    def superseed_check(self, piece_index: int):
+        #Runs when a neighbor turns out to have the piece. It has spread if some neighbor has it that did not
+        #get it from us, or if every neighbor has it and there is nobody left to pass it to.
+        tick_mark = 1 << piece_index
+        if self.superseed_spread & tick_mark:
+            return
+        given = self.superseed_given.get(piece_index, ())
+        holders = [peer_id for peer_id, neighbor in self.peers_info.items() if neighbor.have_mask & tick_mark]
+        if len(holders) < len(self.peers_info) and all(peer_id in given for peer_id in holders):
+            return
+        self.superseed_spread |= tick_mark
+        self.superseed_given.pop(piece_index, None)
+        for peer_id, offers in list(self.superseed_offers.items()):
+            if piece_index in offers:
+                offers.discard(piece_index)
+                self.superseed_offer(peer_id)
+        if self.superseed_spread == self.full_mask:
+            self.finish_super_seeding()
+
+    def finish_super_seeding(self):
+        #Every piece is out in the swarm, so from here on the seed is an ordinary one. Neighbors are told about
+        #the pieces they have not been offered, which also lets them count the seed as having the whole file.
+        self.super_seeding = False
+        self.superseed_offers.clear()
+        logging.info(f"Peer {self.id} ended super-seeding, every piece has reached another peer")
+        for neighbor in self.peers_info.values():
+            unannounced = self.full_mask & ~neighbor.announced_mask
+            while unannounced:
+                lowest = unannounced & -unannounced
+                unannounced ^= lowest
+                self.send_message(neighbor.peer_id, 4, (lowest.bit_length() - 1).to_bytes(4, byteorder="big"))
+            neighbor.announced_mask = self.full_mask
+
+    def count_finished_neighbor(self, peer_id: int):
+        if peer_id not in self.finished_neighbors:
+            self.finished_neighbors.add(peer_id)
+            self.peers_with_whole_file += 1
+
     def check_for_completion(self):
-        if self.bitfield == self.full_bitfield:
+        if self.have_mask == self.full_mask:
             self.peers_with_whole_file += 1
-            try:
-                with open(f"{self.subdir}/{self.file_name}", "wb") as file_bytes:
-                    for index in range(self.num_pieces):
-                        if not self.pieces[index]:
-                            raise RuntimeError("Peer should not be assembling file at current moment")
-                        with open(f"{self.subdir}/partial_piece_{index}_{self.file_name}", "rb") as partial_p:
-                            file_bytes.write(partial_p.read())
-                        os.remove(f"{self.subdir}/partial_piece_{index}_{self.file_name}")
-                logging.info(f"Peer {self.id} has downloaded the complete file.")
-                self.has_file = True
-            except RuntimeError as e:
-                logging.info(f"Error: {e}")
+            #Every piece was already written in place, so completion is only a flush
+            self.piece_store.flush()
+            logging.info(f"Peer {self.id} has downloaded the complete file.")
+            self.has_file = True
 
-    def package_piece(self, piece_index):
-        index_bytes = piece_index.to_bytes(4, byteorder='big')
-        msg_data = None
-        try:
-            if os.path.exists(f"{self.subdir}/{self.file_name}"):
-                #Straight from file
-                with open(f"{self.subdir}/{self.file_name}", "rb") as file_bytes:
-                    file_bytes.seek(piece_index*self.piece_size)
-                    msg_data = file_bytes.read(self.piece_size)
-            elif os.path.exists(f"{self.subdir}/partial_piece_{piece_index}_{self.file_name}"):
-                #From partial file
-                with open(f"{self.subdir}/partial_piece_{piece_index}_{self.file_name}", "rb") as file_bytes:
-                    msg_data = file_bytes.read()
-            else:
-                raise FileNotFoundError(f"Peer is trying to send piece {piece_index} but does not have it")
-        except FileNotFoundError as e:
-            logging.info(f"Error: {e}")
-        message = index_bytes + msg_data
-        return message
-    
     def find_and_request(self, peer_id):
-        if len(self.peers_info[peer_id].interesting_pieces) == 0:
-            return
-        requested_piece = random.choice(self.peers_info[peer_id].interesting_pieces)
-        new_timer = threading.Timer((self.unchoke_int*4), self.restore_interest, args=(requested_piece,))
-        self.timers.append(new_timer)
-        self.current_requests.append(requested_piece)
-        self.remove_interest(requested_piece)
-        new_timer.start()
-        self.send_message(peer_id, 6, (requested_piece).to_bytes(4, byteorder="big"))
-
-    def restore_interest(self, piece_index):
-        piece_byte = piece_index // 8
-        piece_bit = piece_index % 8
-        tick_mark = 1 << (7 - piece_bit)
-        if not bool(self.bitfield[piece_byte] & tick_mark):
-            if piece_index in self.current_requests:
-                self.current_requests.remove(piece_index)
-            for neighbor in self.peers_info.values():
-                if bool(neighbor.bitfield[piece_byte] & tick_mark):
-                    neighbor.interesting_pieces.append(piece_index)
-                    if len(neighbor.interesting_pieces) == 1:
-                        self.send_message(neighbor.peer_id, 2)
-
-    def remove_interest(self, piece_index):
-        for neighbor in self.peers_info.values():
-            if piece_index in neighbor.interesting_pieces:
-                neighbor.interesting_pieces.remove(piece_index)
-                if len(neighbor.interesting_pieces) == 0:
-                    self.send_message(neighbor.peer_id, 3)
+        #Keeps up to request_pipeline_depth requests in flight with an unchoked neighbor
+        #so the link does not sit idle for a round trip after every piece
+        if peer_id not in self.neighbors_unchoking_me:
+            return
+        neighbor = self.peers_info[peer_id]
+        if self.uses_blocks(neighbor):
+            self.request_blocks(peer_id)
+            return
+        requested = False
+        while len(neighbor.outstanding_requests) < self.request_pipeline_depth:
+            candidates = self.interesting_mask(neighbor)
+            if not candidates:
+                candidates = self.endgame_mask(neighbor)
+                if not candidates:
+                    break
+                #Duplicate request, the original keeps its timeout and whichever copy comes first wins
+                requested_piece = random_set_bit(candidates)
+                self.endgame_requests.setdefault(requested_piece, set()).add(peer_id)
+                neighbor.outstanding_requests.add(requested_piece)
+                self.send_message(peer_id, 6, (requested_piece).to_bytes(4, byteorder="big"))
+                continue
+            requested_piece = self.picker.pick(candidates, self.num_pieces_held)
+            self.request_timeouts[requested_piece] = self.scheduler.call_later((self.unchoke_int*4), self.restore_interest, requested_piece, peer_id)
+            self.request_times[requested_piece] = time.monotonic()
+            self.current_requests[requested_piece] = peer_id
+            neighbor.outstanding_requests.add(requested_piece)
+            self.in_flight_mask |= 1 << requested_piece
+            self.send_message(peer_id, 6, (requested_piece).to_bytes(4, byteorder="big"))
+            requested = True
+        if requested:
+            self.update_all_interest()
+
+    def restore_interest(self, piece_index, peer_id):
+        #Runs when a request times out or the neighbor chokes us. A request that was answered
+        #or has since been given to another neighbor is left alone, an endgame duplicate is just dropped.
+        if self.current_requests.get(piece_index) != peer_id:
+            if peer_id in self.endgame_requests.get(piece_index, ()):
+                self.endgame_requests[piece_index].discard(peer_id)
+                self.peers_info[peer_id].outstanding_requests.discard(piece_index)
+            return
+        self.release_request(piece_index)
+        if not (self.have_mask >> piece_index) & 1:
+            self.update_all_interest()
+            for neighbor_id in list(self.neighbors_unchoking_me):
+                self.find_and_request(neighbor_id)
+
+    def endgame_ready(self):
+        #Endgame starts once every missing piece and block has been requested from someone
+        if not self.endgame or not self.in_flight_mask:
+            return False
+        if self.full_mask & ~(self.have_mask | self.in_flight_mask | self.verifying_mask) or self.open_partial_mask:
+            return False
+        if not self.endgame_started:
+            self.endgame_started = True
+            logging.info(f"Peer {self.id} entered endgame with {self.in_flight_mask.bit_count()} pieces in flight")
+        return True
+
+    def endgame_mask(self, neighbor):
+        #From then on the in-flight pieces are also requested from any other unchoked neighbor that has them.
+        #Pieces fetched in blocks get duplicate block requests instead, from next_block.
+        if not self.endgame_ready():
+            return 0
+        asked = 0
+        for piece_index in neighbor.outstanding_requests:
+            asked |= 1 << piece_index
+        return neighbor.have_mask & self.in_flight_mask & ~(self.verifying_mask | neighbor.bad_pieces | asked | self.partial_mask)
+
+    def cancel_duplicates(self, piece_index: int, peer_id: int):
+        #The first copy of an endgame piece is in, the other neighbors it was asked from are told not to send theirs
+        askers = self.endgame_requests.pop(piece_index, None)
+        if not askers:
+            return
+        askers.add(self.current_requests.get(piece_index))
+        askers.discard(None)
+        for other_id in askers:
+            self.peers_info[other_id].outstanding_requests.discard(piece_index)
+            if other_id != peer_id:
+                self.send_message(other_id, 8, (piece_index).to_bytes(4, byteorder="big"))
+
+    def cancel_piece(self, peer_id: int, piece_index: int):
+        return self.outbound[peer_id].cancel_piece(piece_index)
+
+    def cancel_block(self, peer_id: int, piece_index: int, offset: int, length: int):
+        return self.outbound[peer_id].cancel_block(piece_index, offset, length)
+
+    def uses_blocks(self, neighbor):
+        #Pieces are fetched in blocks from neighbors that advertised it, unless a piece is a single block anyway
+        return self.block_size < self.piece_size and neighbor.capabilities & CAPABILITY_BLOCKS
+
+    def block_bounds(self, piece_index: int, block_index: int):
+        start, end = self.piece_store.piece_bounds(piece_index)
+        offset = block_index * self.block_size
+        return offset, min(self.block_size, end - start - offset)
+
+    def request_blocks(self, peer_id: int):
+        #Block counterpart of find_and_request, keeping as many bytes in flight as request_pipeline_depth whole pieces would
+        neighbor = self.peers_info[peer_id]
+        masks = (self.in_flight_mask, self.open_partial_mask)
+        while len(neighbor.outstanding_blocks) < self.request_pipeline_depth * self.blocks_per_piece:
+            block = self.next_block(neighbor)
+            if block is None:
+                break
+            piece_index, block_index = block
+            partial = self.partial_pieces[piece_index]
+            askers = partial.askers.setdefault(block_index, set())
+            if not askers:
+                #Endgame duplicates go by the first request's timeout, as whole pieces do
+                self.block_timeouts[block] = self.scheduler.call_later(self.unchoke_int*4, self.block_timed_out, piece_index, block_index)
+            askers.add(peer_id)
+            partial.requested |= 1 << block_index
+            neighbor.outstanding_blocks.add(block)
+            self.refresh_partial(piece_index)
+            offset, length = self.block_bounds(piece_index, block_index)
+            self.send_message(peer_id, 10, self.encode_block_request(piece_index, offset, length))
+        #Most block requests go to pieces already started, which leaves every neighbor's interest as it was
+        if masks != (self.in_flight_mask, self.open_partial_mask):
+            self.update_all_interest()
+
+    def next_block(self, neighbor):
+        #Missing blocks of pieces already started come first, so neighbors join in on a piece instead of each starting their own.
+        #One a neighbor without blocks was since asked for whole is left to it.
+        usable = neighbor.have_mask & ~neighbor.bad_pieces
+        if usable & self.open_partial_mask:
+            for piece_index, partial in self.partial_pieces.items():
+                open_blocks = partial.open_blocks()
+                if open_blocks and (usable >> piece_index) & 1 and piece_index not in self.current_requests:
+                    return piece_index, (open_blocks & -open_blocks).bit_length() - 1
+        candidates = usable & ~(self.have_mask | self.in_flight_mask | self.verifying_mask | self.partial_mask)
+        if candidates:
+            piece_index = self.picker.pick(candidates, self.num_pieces_held)
+            start, end = self.piece_store.piece_bounds(piece_index)
+            self.partial_pieces[piece_index] = PartialPiece(math.ceil((end - start) / self.block_size))
+            self.partial_mask |= 1 << piece_index
+            self.request_times[piece_index] = time.monotonic()
+            return piece_index, 0
+        if not self.endgame_ready():
+            return None
+        #Endgame, blocks already asked from another neighbor are asked from this one too
+        for piece_index, partial in self.partial_pieces.items():
+            if (usable >> piece_index) & 1:
+                for block_index, askers in partial.askers.items():
+                    if neighbor.peer_id not in askers:
+                        return piece_index, block_index
+        return None
+
+    def refresh_partial(self, piece_index: int):
+        #Keeps the piece masks in step with a partial piece's blocks. An idle one, with no block requested,
+        #is left out of the in-flight pieces so neighbors that do not speak blocks can fetch it whole.
+        partial = self.partial_pieces[piece_index]
+        tick_mark = 1 << piece_index
+        if partial.open_blocks():
+            self.open_partial_mask |= tick_mark
+        else:
+            self.open_partial_mask &= ~tick_mark
+        if partial.requested:
+            self.in_flight_mask |= tick_mark
+        elif piece_index not in self.current_requests:
+            self.in_flight_mask &= ~tick_mark
+
+    def release_block(self, piece_index: int, block_index: int, answered_by = None):
+        #Clears every request for the block. When it has just arrived, the other neighbors it was
+        #asked from during endgame are told not to send it.
+        partial = self.partial_pieces[piece_index]
+        for asker in partial.askers.pop(block_index, ()):
+            self.peers_info[asker].outstanding_blocks.discard((piece_index, block_index))
+            if answered_by is not None and asker != answered_by:
+                offset, length = self.block_bounds(piece_index, block_index)
+                self.send_message(asker, 8, self.encode_block_request(piece_index, offset, length))
+        partial.requested &= ~(1 << block_index)
+        timeout = self.block_timeouts.pop((piece_index, block_index), None)
+        if timeout is not None:
+            self.scheduler.cancel(timeout)
+
+    def release_neighbor_blocks(self, peer_id: int):
+        #The neighbor choked us, its blocks go back to the others unless an endgame duplicate is still out
+        neighbor = self.peers_info[peer_id]
+        for piece_index, block_index in list(neighbor.outstanding_blocks):
+            askers = self.partial_pieces[piece_index].askers[block_index]
+            askers.discard(peer_id)
+            if not askers:
+                self.release_block(piece_index, block_index)
+            self.refresh_partial(piece_index)
+        neighbor.outstanding_blocks.clear()
+
+    def block_timed_out(self, piece_index: int, block_index: int):
+        self.block_timeouts.pop((piece_index, block_index), None)
+        if piece_index not in self.partial_pieces:
+            return
+        self.release_block(piece_index, block_index)
+        self.refresh_partial(piece_index)
+        self.update_all_interest()
+        for neighbor_id in list(self.neighbors_unchoking_me):
+            self.find_and_request(neighbor_id)
+
+    def drop_partial(self, piece_index: int, peer_id: int):
+        #The whole piece came from a neighbor that does not speak blocks, blocks still asked for are cancelled
+        partial = self.partial_pieces[piece_index]
+        for block_index in list(partial.askers):
+            self.release_block(piece_index, block_index, peer_id)
+        del self.partial_pieces[piece_index]
+        self.partial_mask &= ~(1 << piece_index)
+        self.open_partial_mask &= ~(1 << piece_index)
+
+    def assemble_piece(self, piece_index: int, peer_id: int):
+        #Every block is in, from here on it is handled like a piece that arrived whole. Each block was
+        #already credited to the rate of the neighbor that sent it.
+        partial = self.partial_pieces.pop(piece_index)
+        tick_mark = 1 << piece_index
+        self.partial_mask &= ~tick_mark
+        self.open_partial_mask &= ~tick_mark
+        requested_at = self.request_times.pop(piece_index, None)
+        if requested_at is not None:
+            self.metrics.request_latency.observe(time.monotonic() - requested_at)
+        self.metrics.neighbors[peer_id].pieces_received += 1
+        self.cancel_duplicates(piece_index, peer_id)
+        if self.manifest is None:
+            self.accept_piece(peer_id, piece_index, 0)
+            return
+        self.verifying_mask |= tick_mark
+        future = self.hash_pool.submit(self.manifest.check, self.piece_store, piece_index)
+        future.add_done_callback(lambda done, peer_id=peer_id, piece_index=piece_index, senders=partial.senders:
+                                 self.dispatch(self.piece_checked, peer_id, piece_index, 0, done.result(), senders))
+
+    def cancel_request_timeout(self, piece_index):
+        timeout = self.request_timeouts.pop(piece_index, None)
+        if timeout is not None:
+            self.scheduler.cancel(timeout)
+
+    def pending_request_timeouts(self):
+        #Piece and block requests still waiting on their timeout, other timers are left out
+        return len(self.request_timeouts) + len(self.block_timeouts)
+
+    def interesting_mask(self, neighbor):
+        #Pieces the neighbor has that we neither hold nor have already asked someone for,
+        #leaving out any it has sent corrupted before
+        mask = neighbor.have_mask & ~(self.have_mask | self.in_flight_mask | self.verifying_mask | neighbor.bad_pieces)
+        if self.uses_blocks(neighbor):
+            #Started pieces with blocks nobody has been asked for yet
+            mask |= neighbor.have_mask & self.open_partial_mask & ~neighbor.bad_pieces
+        return mask
+
+    def update_interest(self, peer_id):
+        #Sends interested / not interested only when the neighbor's interesting set changes between empty and non-empty
+        neighbor = self.peers_info[peer_id]
+        interested = self.interesting_mask(neighbor) != 0
+        if interested != neighbor.interested_in_them:
+            neighbor.interested_in_them = interested
+            self.send_message(peer_id, 2 if interested else 3)
+
+    def update_all_interest(self):
+        for peer_id in list(self.peers_info.keys()):
+            self.update_interest(peer_id)
     
     # TODO: choking and unchoking
     def start_unchoke_timers(self):
-        self.unchoke_timer = threading.Timer(self.unchoke_int, self.perform_unchoking)
-        self.unchoke_timer.start()
-        self.opt_unchoke_timer = threading.Timer(self.opt_unchoke_int, self.perform_optimistic_unchoking)
-        self.opt_unchoke_timer.start()
+        self.scheduler.start()
+        self.unchoke_timer = self.scheduler.call_later(self.unchoke_int, self.unchoking_round)
+        self.opt_unchoke_timer = self.scheduler.call_later(self.opt_unchoke_int, self.optimistic_unchoking_round)
+        if self.metrics_interval > 0:
+            self.metrics_timer = self.scheduler.call_later(self.metrics_interval, self.metrics_round)
+
+    def resume_unchoke_timers(self):
+        #The rounds stop while every connected neighbor has the whole file, a neighbor that connects
+        #again after a restart may not
+        if self.unchoke_timer is None:
+            self.unchoke_timer = self.scheduler.call_later(self.unchoke_int, self.unchoking_round)
+        if self.opt_unchoke_timer is None:
+            self.opt_unchoke_timer = self.scheduler.call_later(self.opt_unchoke_int, self.optimistic_unchoking_round)
+
+    def metrics_round(self):
+        self.write_metrics()
+        self.metrics_timer = self.scheduler.call_later(self.metrics_interval, self.metrics_round)
+
+    def sent_counters(self, peer_id: int):
+        return self.outbound[peer_id].sent
+
+    def buffered_bytes(self, peer_id: int):
+        framer = self.peer_buffers.get(peer_id)
+        return framer.buffered() if framer is not None else 0
+
+    def metrics_snapshot(self):
+        neighbors = dict()
+        for peer_id, neighbor in self.peers_info.items():
+            counters = self.metrics.neighbors[peer_id]
+            connected = peer_id in self.outbound
+            sent = self.sent_counters(peer_id) if connected else SendCounters()
+            neighbors[str(peer_id)] = {
+                **sent.snapshot(),
+                "bytes_received": counters.bytes_received,
+                "pieces_received": counters.pieces_received,
+                "blocks_received": counters.blocks_received,
+                "compression": bool(neighbor.capabilities & CAPABILITY_COMPRESSION),
+                "compressed_pieces_received": counters.compressed_pieces_received,
+                "requests_in_flight": len(neighbor.outstanding_requests),
+                "block_requests_in_flight": len(neighbor.outstanding_blocks),
+                "receive_buffered_bytes": self.buffered_bytes(peer_id),
+                "send_queued_bytes": self.unsent_bytes(peer_id) if connected else 0,
+                "download_rate": self.download_rates[peer_id].rate,
+                "upload_rate": self.upload_rates[peer_id].rate,
+                "pieces_held": neighbor.have_mask.bit_count(),
+                "choking_me": peer_id not in self.neighbors_unchoking_me,
+                "choked_by_me": peer_id not in self.preferred_neighbors and peer_id != self.optimistically_unchoked_peer,
+                "interested_in_me": neighbor.interested_in_me,
+                "interested_in_them": neighbor.interested_in_them,
+                "chokes_received": counters.chokes_received,
+                "unchokes_received": counters.unchokes_received,
+                "chokes_sent": counters.chokes_sent,
+                "unchokes_sent": counters.unchokes_sent,
+            }
+        return {
+            "peer_id": self.id,
+            "time": time.time(),
+            "uptime": time.monotonic() - self.metrics.started,
+            "pieces_held": self.num_pieces_held,
+            "num_pieces": self.num_pieces,
+            "pieces_in_flight": self.in_flight_mask.bit_count(),
+            "pieces_verifying": self.verifying_mask.bit_count(),
+            "pieces_partial": len(self.partial_pieces),
+            "endgame": self.endgame_started,
+            "super_seeding": self.super_seeding,
+            "pieces_spread": self.superseed_spread.bit_count(),
+            "pending_timers": self.scheduler.pending(),
+            "pending_request_timeouts": self.pending_request_timeouts(),
+            "request_latency": self.metrics.request_latency.snapshot(),
+            "piece_cache": self.compressed_pieces.snapshot() if self.compressed_pieces is not None else None,
+            "neighbors": neighbors,
+        }
+
+    def write_metrics(self):
+        #Written to a temporary file and renamed so a reader never sees half a snapshot
+        try:
+            with open(f"{self.metrics_path}.tmp", "w") as file:
+                json.dump(self.metrics_snapshot(), file, indent=1)
+            os.replace(f"{self.metrics_path}.tmp", self.metrics_path)
+        except OSError as e:
+            logging.info(f"Error: {e}")
+
+    #The rounds reschedule themselves, perform_unchoking is also called directly when a neighbor connects
+    def unchoking_round(self):
+        if self.peers_with_whole_file == len(self.connections.keys())+1:
+            self.unchoke_timer = None
+            return
+        self.perform_unchoking()
+        self.unchoke_timer = self.scheduler.call_later(self.unchoke_int, self.unchoking_round)
+
+    def optimistic_unchoking_round(self):
+        if self.peers_with_whole_file == len(self.connections.keys())+1:
+            self.opt_unchoke_timer = None
+            return
+        self.perform_optimistic_unchoking()
+        self.opt_unchoke_timer = self.scheduler.call_later(self.opt_unchoke_int, self.optimistic_unchoking_round)
 
     def perform_unchoking(self):
         if self.peers_with_whole_file == len(self.connections.keys())+1:
             return
         num_neighbors = min(self.numPrefNbors, len(self.peers_info.keys()))
         with self.unchoke_lock:
-            if not self.has_file:
-                filtered_download_rates = {k: v for k, v in self.download_rates.items() if k in self.neighbors_interested}
-                sorted_peers = sorted(filtered_download_rates, key=filtered_download_rates.get, reverse=True)
-                new_preferred_neighbors = set(sorted_peers[:num_neighbors])
-                #Handling is there are less interested than amount for preferred
-                if len(new_preferred_neighbors) < num_neighbors:
-                    uninterested_download_rates = {k: v for k, v in self.download_rates.items() if k not in self.neighbors_interested}
-                    extra_preferred_neighbors = set(random.sample(list(uninterested_download_rates.keys()), (num_neighbors - len(new_preferred_neighbors))))
-                    new_preferred_neighbors = new_preferred_neighbors.union(extra_preferred_neighbors)
-            else:
-                new_preferred_neighbors = set(random.sample(list(self.peers_info.keys()), num_neighbors))
+            now = time.monotonic()
+            for peer_id in self.peers_info.keys():
+                self.download_rates[peer_id].update(now)
+                self.upload_rates[peer_id].update(now)
+            #A leecher prefers the neighbors that send it the most, a seeder the ones that take the most from it
+            rates = self.upload_rates if self.has_file else self.download_rates
+            interested = [peer_id for peer_id in self.peers_info.keys() if peer_id in self.neighbors_interested]
+            #Shuffled first so that neighbors with equal rates, such as new ones, are picked at random
+            random.shuffle(interested)
+            interested.sort(key=lambda peer_id: rates[peer_id].rate, reverse=True)
+            new_preferred_neighbors = set(interested[:num_neighbors])
+            #Handling is there are less interested than amount for preferred
+            if len(new_preferred_neighbors) < num_neighbors:
+                uninterested = [peer_id for peer_id in self.peers_info.keys() if peer_id not in self.neighbors_interested]
+                extra_preferred_neighbors = set(random.sample(uninterested, (num_neighbors - len(new_preferred_neighbors))))
+                new_preferred_neighbors = new_preferred_neighbors.union(extra_preferred_neighbors)
             if new_preferred_neighbors != self.preferred_neighbors:
                 logging.info(f"Peer {self.id} has the preferred neighbors {','.join(map(str, sorted(new_preferred_neighbors)))}")
             for peer_id in new_preferred_neighbors - self.preferred_neighbors:
@@ -397,9 +1269,6 @@ class PeerProcess():
             for peer_id in self.preferred_neighbors - new_preferred_neighbors:
                 self.send_message(peer_id, 0)  # Choke message
             self.preferred_neighbors = new_preferred_neighbors
-            self.download_rates = {peer: 0 for peer in self.peers_info.keys()}
-        self.unchoke_timer = threading.Timer(self.unchoke_int, self.perform_unchoking)
-        self.unchoke_timer.start()
 
     def perform_optimistic_unchoking(self):
         if self.peers_with_whole_file == len(self.connections.keys())+1:
@@ -416,21 +1285,1717 @@ class PeerProcess():
                     self.send_message(self.optimistically_unchoked_peer, 0)  # Choke message
                 self.send_message(new_optimistically_unchoked_peer, 1)  # Unchoke message
                 self.optimistically_unchoked_peer = new_optimistically_unchoked_peer
-        self.opt_unchoke_timer = threading.Timer(self.opt_unchoke_int, self.perform_optimistic_unchoking)
-        self.opt_unchoke_timer.start()
 
     def update_download_rate(self, peer_id, bytes_downloaded):
-        self.download_rates[peer_id] += bytes_downloaded
+        self.download_rates[peer_id].add(bytes_downloaded)
             
 
+class AsyncPeerProcess(PeerProcess):
+    #Engine selected with --engine asyncio. Each connection is a stream reader/writer pair with
+    #one task framing incoming messages and one task draining that neighbor's outbound queue,
+    #and the unchoking rounds and request timeouts run on the loop's timers. Message handling is
+    #inherited unchanged, so it speaks the same protocol as the threaded engine.
+    async def run(self, prev_peers):
+        self.loop = asyncio.get_running_loop()
+        self.scheduler = LoopScheduler(self.loop)
+        self.finished = asyncio.Event()
+        self.outbound = dict()
+        #Pieces and blocks queued for each neighbor and not yet written, and those of them the neighbor cancelled
+        self.queued_pieces = dict()
+        self.cancelled_pieces = dict()
+        #SendCounters of each neighbor
+        self.sent = dict()
+        self.tasks = set()
+        #Writer task of each neighbor, and the neighbors a dial_peer loop is running for
+        self.write_tasks = dict()
+        self.dial_loops = set()
+        #Every other peer is dialed at once and may also connect to us first, as in ConnectionManager
+        self.known_peers = {peer.peer_id: peer for peer in list(prev_peers) + list(self.next_peers)}
+        self.earlier_peers = {peer.peer_id for peer in prev_peers}
+        self.dialing = set()
+        self.num_peers = len(self.known_peers) + 1
+        server = await asyncio.start_server(self.accept_peer, sock=self.listening_socket)
+        for peer in self.known_peers.values():
+            self.spawn(self.dial_peer(peer))
+        self.start_unchoke_timers()
+        self.check_finished()
+        await self.finished.wait()
+
+        #Let the final have messages go out before closing
+        try:
+            await asyncio.wait_for(asyncio.gather(*(outbound.join() for outbound in self.outbound.values())), timeout=5)
+        except asyncio.TimeoutError:
+            pass
+        if self.metrics_interval > 0:
+            self.write_metrics()
+        server.close()
+        for writer in self.connections.values():
+            writer.close()
+        self.scheduler.stop()
+        for task in list(self.tasks):
+            task.cancel()
+
+    def dispatch(self, function, *args):
+        #Pool threads hand their results back to the event loop, and a verified piece may be the last one
+        def run():
+            try:
+                function(*args)
+            except (OSError, ValueError) as e:
+                logging.info(f"Error: {e}")
+            self.check_finished()
+        self.loop.call_soon_threadsafe(run)
+
+    def spawn(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def check_finished(self):
+        if self.peers_with_whole_file >= self.num_peers:
+            self.finished.set()
+
+    async def dial_peer(self, peer):
+        #Retries with exponential backoff until the neighbor is connected either way
+        delay = ConnectionManager.FIRST_RETRY
+        self.dial_loops.add(peer.peer_id)
+        try:
+            while peer.peer_id not in self.connections and not self.finished.is_set():
+                self.dialing.add(peer.peer_id)
+                writer = None
+                try:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(peer.host_name, peer.port_num), ConnectionManager.CONNECT_TIMEOUT)
+                    writer.write(self.make_handshake_header(self.id, self.capabilities))
+                    answer_id, answer_capabilities = self.read_handshake_header(await asyncio.wait_for(reader.readexactly(32), ConnectionManager.HANDSHAKE_TIMEOUT))
+                    if answer_id != peer.peer_id:
+                        raise ValueError("Unexpected header, something with the connection has failed")
+                except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                    #Refused or closed just means the neighbor is not up yet or kept its own connection to us
+                    if isinstance(e, ValueError):
+                        logging.info(f"Error: {e}")
+                    if writer is not None:
+                        writer.close()
+                    self.dialing.discard(peer.peer_id)
+                    await asyncio.sleep(delay * random.uniform(0.5, 1))
+                    delay = min(2 * delay, ConnectionManager.MAX_RETRY)
+                    continue
+                self.dialing.discard(peer.peer_id)
+                if peer.peer_id in self.connections:
+                    writer.close()
+                    return
+                logging.info(f"Peer {self.id} makes a connection to Peer {peer.peer_id}")
+                self.start_connection(peer, reader, writer, answer_capabilities & self.capabilities)
+        finally:
+            self.dial_loops.discard(peer.peer_id)
+
+    async def accept_peer(self, reader, writer):
+        try:
+            header = await asyncio.wait_for(reader.readexactly(32), ConnectionManager.CONNECT_TIMEOUT)
+            conn_id, capabilities = self.read_handshake_header(header)
+            if conn_id not in self.known_peers:
+                raise ConnectionError("Header has an incorrect peer id")
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            logging.info(f"Error: {e}")
+            writer.close()
+            return
+        #Both sides dialing: the connection dialed by the peer listed later in PeerInfo.cfg is kept
+        if conn_id in self.connections or (conn_id in self.dialing and conn_id in self.earlier_peers):
+            writer.close()
+            return
+        logging.info(f"Peer {self.id} is connected from Peer {conn_id}")
+        #Only capabilities the dialer advertised are echoed, so a dialer that knows none sees the plain handshake
+        capabilities &= self.capabilities
+        writer.write(self.make_handshake_header(self.id, capabilities))
+        self.start_connection(self.known_peers[conn_id], reader, writer, capabilities)
+
+    def start_connection(self, peer, reader, writer, capabilities: int):
+        self.setup_neighbor(peer, capabilities)
+        self.connections[peer.peer_id] = writer
+        self.outbound[peer.peer_id] = asyncio.Queue()
+        self.queued_pieces[peer.peer_id] = set()
+        self.cancelled_pieces[peer.peer_id] = set()
+        self.sent[peer.peer_id] = SendCounters()
+        self.write_tasks[peer.peer_id] = self.spawn(self.write_loop(peer.peer_id, writer))
+        self.spawn(self.read_loop(peer.peer_id, reader))
+        self.resume_unchoke_timers()
+        self.perform_unchoking()
+        self.announce_pieces(peer.peer_id)
+
+    def send_message(self, peer_id: int, msg_type: int, data = None):
+        if msg_type <= 1:
+            self.metrics.count_choke_sent(peer_id, msg_type)
+        self.outbound[peer_id].put_nowait(self.encode_message(msg_type, data))
+
+    def sent_counters(self, peer_id: int):
+        return self.sent[peer_id]
+
+    def close_connection(self, peer_id: int):
+        writer = self.connections.pop(peer_id)
+        self.write_tasks.pop(peer_id).cancel()
+        for table in (self.outbound, self.queued_pieces, self.cancelled_pieces, self.sent):
+            del table[peer_id]
+        writer.close()
+
+    def redial(self, peer_id: int):
+        if peer_id not in self.dial_loops and not self.finished.is_set():
+            self.spawn(self.dial_peer(self.known_peers[peer_id]))
+
+    def unsent_bytes(self, peer_id: int):
+        #Counts every queued piece as a full one, which only errs towards holding back
+        queued = sum(item[2] + 13 if isinstance(item, tuple) else self.piece_size + 9 for item in self.queued_pieces[peer_id])
+        return queued + self.connections[peer_id].transport.get_write_buffer_size()
+
+    def send_piece(self, peer_id: int, piece_index: int):
+        #Queued by index, the payload is only read once the writer gets to it
+        self.queued_pieces[peer_id].add(piece_index)
+        self.outbound[peer_id].put_nowait(piece_index)
+
+    def cancel_piece(self, peer_id: int, piece_index: int):
+        if piece_index not in self.queued_pieces[peer_id]:
+            return False
+        self.cancelled_pieces[peer_id].add(piece_index)
+        return True
+
+    def send_block(self, peer_id: int, piece_index: int, offset: int, length: int):
+        self.queued_pieces[peer_id].add((piece_index, offset, length))
+        self.outbound[peer_id].put_nowait((piece_index, offset, length))
+
+    def cancel_block(self, peer_id: int, piece_index: int, offset: int, length: int):
+        return self.cancel_piece(peer_id, (piece_index, offset, length))
+
+    async def write_loop(self, peer_id: int, writer):
+        outbound = self.outbound[peer_id]
+        compressor = self.piece_compressor(peer_id)
+        try:
+            while True:
+                #Everything already queued goes to the transport in one write
+                items = [await outbound.get()]
+                while not outbound.empty():
+                    items.append(outbound.get_nowait())
+                buffers = list()
+                sent = self.sent[peer_id]
+                for item in items:
+                    if isinstance(item, tuple):
+                        self.queued_pieces[peer_id].discard(item)
+                        if item in self.cancelled_pieces[peer_id]:
+                            self.cancelled_pieces[peer_id].discard(item)
+                            continue
+                        piece_index, offset, length = item
+                        start = self.piece_store.piece_bounds(piece_index)[0] + offset
+                        buffers.append(self.encode_block_header(piece_index, offset, length))
+                        buffers.append(self.piece_store.map[start:start + length])
+                        sent.blocks_sent += 1
+                        self.upload_rates[peer_id].add(length)
+                    elif isinstance(item, int):
+                        self.queued_pieces[peer_id].discard(item)
+                        if item in self.cancelled_pieces[peer_id]:
+                            self.cancelled_pieces[peer_id].discard(item)
+                            continue
+                        start, end = self.piece_store.piece_bounds(item)
+                        compressed = None
+                        if compressor is not None:
+                            compressed = compressor.cached(item)
+                            if compressed is CompressedPieceCache.MISSING:
+                                #Compressing is left to the pool so it does not hold up the loop
+                                compressed = await self.loop.run_in_executor(self.hash_pool, compressor.get, item)
+                        if compressed is not None:
+                            buffers.append(compressor.encode_header(item, len(compressed)))
+                            buffers.append(compressed)
+                            sent.compressed_pieces_sent += 1
+                            sent.compression_bytes_saved += end - start - len(compressed)
+                        else:
+                            buffers.append(self.encode_piece_header(item, end - start))
+                            buffers.append(self.piece_store.read_piece(item))
+                        sent.pieces_sent += 1
+                        self.upload_rates[peer_id].add(end - start)
+                    else:
+                        buffers.append(item)
+                        sent.messages_sent += 1
+                writer.writelines(buffers)
+                sent.bytes_sent += sum(len(buffer) for buffer in buffers)
+                sent.send_calls += 1
+                for item in items:
+                    outbound.task_done()
+                await writer.drain()
+        except OSError as e:
+            logging.info(f"Error: {e}")
+
+    async def read_loop(self, peer_id: int, reader):
+        try:
+            while not self.finished.is_set():
+                length_bytes = await reader.readexactly(4)
+                body = await reader.readexactly(int.from_bytes(length_bytes, byteorder='big'))
+                self.metrics.neighbors[peer_id].bytes_received += 4 + len(body)
+                self.read_message(peer_id, length_bytes + body)
+                self.check_finished()
+            return
+        except asyncio.IncompleteReadError:
+            #Neighbor closed the connection
+            pass
+        except OSError as e:
+            logging.info(f"Error: {e}")
+        if not self.finished.is_set():
+            self.drop_neighbor(peer_id)
+
+
+class HandshakeAttempt():
+    def __init__(self, sock, peer_id, outbound: bool, deadline: float):
+        self.sock = sock
+        #Not known for an inbound connection until its handshake has been read
+        self.peer_id = peer_id
+        self.outbound = outbound
+        #Outbound connections wait for connect to finish before sending the handshake
+        self.connecting = outbound
+        self.received = bytearray()
+        self.deadline = deadline
+
+
+class ConnectionManager():
+    #Sets up every neighbor connection of the threaded engine from one thread with non-blocking
+    #sockets. All other peers are dialed at once, and a failed dial is retried with exponential
+    #backoff until that neighbor is connected one way or the other. It runs for the life of the
+    #process, so a neighbor whose connection is lost is dialed again and can also connect to us
+    #again after a restart. Connecting times out after CONNECT_TIMEOUT, and the answer to our
+    #handshake after HANDSHAKE_TIMEOUT. A neighbor that accepts a handshake we gave up on finds the
+    #connection closed and drops it, and the two peers then connect again.
+    #Inbound handshakes are accepted from any listed peer in any order. When two peers dial each
+    #other at the same time, the connection dialed by the peer listed later in PeerInfo.cfg is kept.
+    #The acceptor decides this before replying, so both sides always keep the same one.
+    CONNECT_TIMEOUT = 5
+    HANDSHAKE_TIMEOUT = 30
+    FIRST_RETRY = 0.05
+    MAX_RETRY = 2
+
+    def __init__(self, peer_process, prev_peers, next_peers):
+        self.peer_process = peer_process
+        self.peers = {peer.peer_id: peer for peer in list(prev_peers) + list(next_peers)}
+        self.earlier_peers = {peer.peer_id for peer in prev_peers}
+        #Handshakes in progress by socket, and the outbound ones by neighbor
+        self.attempts = dict()
+        self.dialing = dict()
+        self.retry_delays = {peer_id: self.FIRST_RETRY for peer_id in self.peers}
+        self.retries = list()
+        #Neighbors whose connection was lost, handed over from the thread that noticed
+        self.lost = queue.SimpleQueue()
+        self.running = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        now = time.monotonic()
+        for peer_id in self.peers:
+            heapq.heappush(self.retries, (now, peer_id))
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        #The listening socket is closed right after, so wait for the thread to stop using it
+        self.running = False
+        self.thread.join(1)
+
+    def connected(self, peer_id: int):
+        return peer_id in self.peer_process.connections
+
+    def redial(self, peer_id: int):
+        self.lost.put(peer_id)
+
+    def run(self):
+        listening_socket = self.peer_process.listening_socket
+        listening_socket.setblocking(False)
+        while self.running:
+            now = time.monotonic()
+            while not self.lost.empty():
+                #Starts over from the shortest delay, the neighbor may come back right away
+                peer_id = self.lost.get()
+                self.retry_delays[peer_id] = self.FIRST_RETRY
+                heapq.heappush(self.retries, (now, peer_id))
+            while self.retries and self.retries[0][0] <= now:
+                _, peer_id = heapq.heappop(self.retries)
+                if not self.connected(peer_id) and peer_id not in self.dialing:
+                    self.dial(peer_id, now)
+            for attempt in [attempt for attempt in self.attempts.values() if attempt.deadline <= now]:
+                self.fail(attempt)
+            readable = [listening_socket] + [attempt.sock for attempt in self.attempts.values() if not attempt.connecting]
+            writable = [attempt.sock for attempt in self.attempts.values() if attempt.connecting]
+            wake_up = [now + 0.5] + [attempt.deadline for attempt in self.attempts.values()]
+            if self.retries:
+                wake_up.append(self.retries[0][0])
+            read_sockets, write_sockets, _ = select.select(readable, writable, [], max(0, min(wake_up) - now))
+            for sock in write_sockets:
+                if sock in self.attempts:
+                    self.send_handshake(self.attempts[sock])
+            for sock in read_sockets:
+                if sock is listening_socket:
+                    self.accept()
+                elif sock in self.attempts:
+                    self.receive(self.attempts[sock])
+        for attempt in list(self.attempts.values()):
+            self.close(attempt)
+
+    def dial(self, peer_id: int, now: float):
+        peer = self.peers[peer_id]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            error = sock.connect_ex((peer.host_name, peer.port_num))
+        except OSError as e:
+            error = e.errno
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self.schedule_retry(peer_id, now)
+            return
+        attempt = HandshakeAttempt(sock, peer_id, True, now + self.CONNECT_TIMEOUT)
+        self.attempts[sock] = attempt
+        self.dialing[peer_id] = attempt
+
+    def send_handshake(self, attempt):
+        error = attempt.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error != 0:
+            self.fail(attempt)
+            return
+        attempt.connecting = False
+        attempt.deadline = time.monotonic() + self.HANDSHAKE_TIMEOUT
+        try:
+            attempt.sock.send(self.peer_process.make_handshake_header(self.peer_process.id, self.peer_process.capabilities))
+        except OSError:
+            self.fail(attempt)
+
+    def accept(self):
+        try:
+            conn, addr = self.peer_process.listening_socket.accept()
+        except OSError:
+            return
+        conn.setblocking(False)
+        attempt = HandshakeAttempt(conn, None, False, time.monotonic() + self.CONNECT_TIMEOUT)
+        self.attempts[conn] = attempt
+
+    def receive(self, attempt):
+        try:
+            data = attempt.sock.recv(32 - len(attempt.received))
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.fail(attempt)
+            return
+        attempt.received += data
+        if len(attempt.received) == 32:
+            del self.attempts[attempt.sock]
+            if attempt.outbound:
+                self.complete_outbound(attempt)
+            else:
+                self.complete_inbound(attempt)
+
+    def complete_outbound(self, attempt):
+        peer_process = self.peer_process
+        del self.dialing[attempt.peer_id]
+        try:
+            peer_id, capabilities = peer_process.read_handshake_header(bytes(attempt.received))
+            if peer_id != attempt.peer_id:
+                raise ValueError("Header has an incorrect peer id")
+        except ValueError as e:
+            logging.info(f"Error: Unexpected header from Peer {attempt.peer_id}, {e}")
+            self.fail(attempt)
+            return
+        with peer_process.state_lock:
+            if self.connected(attempt.peer_id):
+                attempt.sock.close()
+                return
+            peer_process.establish_connection(self.peers[attempt.peer_id], attempt.sock, True, capabilities & peer_process.capabilities)
+
+    def complete_inbound(self, attempt):
+        peer_process = self.peer_process
+        try:
+            peer_id, capabilities = peer_process.read_handshake_header(bytes(attempt.received))
+            if peer_id not in self.peers:
+                raise ValueError("Header has an incorrect peer id")
+        except ValueError as e:
+            logging.info(f"Error: {e}")
+            attempt.sock.close()
+            return
+        #Only capabilities the dialer advertised are echoed, so a dialer that knows none sees the plain handshake
+        capabilities &= peer_process.capabilities
+        with peer_process.state_lock:
+            if self.connected(peer_id) or (peer_id in self.dialing and peer_id in self.earlier_peers):
+                #Already connected, or both sides are dialing and our own connection is the one kept
+                attempt.sock.close()
+                return
+            try:
+                attempt.sock.setblocking(True)
+                attempt.sock.sendall(peer_process.make_handshake_header(peer_process.id, capabilities))
+            except OSError as e:
+                logging.info(f"Error: {e}")
+                attempt.sock.close()
+                return
+            peer_process.establish_connection(self.peers[peer_id], attempt.sock, False, capabilities)
+        #The neighbor drops our own dial to it, no need to wait for that
+        if peer_id in self.dialing:
+            self.close(self.dialing.pop(peer_id))
+
+    def fail(self, attempt):
+        #Refused, reset or timed out. Expected while the neighbor has not started yet, so not logged.
+        self.close(attempt)
+        if attempt.outbound:
+            self.dialing.pop(attempt.peer_id, None)
+            if not self.connected(attempt.peer_id):
+                self.schedule_retry(attempt.peer_id, time.monotonic())
+
+    def close(self, attempt):
+        self.attempts.pop(attempt.sock, None)
+        attempt.sock.close()
+
+    def schedule_retry(self, peer_id: int, now: float):
+        #Jittered so peers that failed together do not all retry together
+        delay = self.retry_delays[peer_id]
+        self.retry_delays[peer_id] = min(2 * delay, self.MAX_RETRY)
+        heapq.heappush(self.retries, (now + delay * random.uniform(0.5, 1), peer_id))
+
+
+class MessageFramer():
+    #Receive buffer of one connection. Data is read with recv_into into a preallocated buffer and
+    #complete messages are handed out as memoryview slices of it, so a message is never copied
+    #on the way to read_message. Only the tail of an unfinished message is ever moved, back to the
+    #front of the buffer once the free space at the end runs low.
+    def __init__(self, capacity: int):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def buffered(self):
+        return self.end - self.start
+
+    def make_room(self, needed: int):
+        remaining = self.end - self.start
+        if needed > len(self.buffer):
+            #A message bigger than the buffer, replace it rather than resize since views may still be out
+            new_buffer = bytearray(max(needed, 2 * len(self.buffer)))
+            new_buffer[0:remaining] = self.view[self.start:self.end]
+            self.buffer = new_buffer
+            self.view = memoryview(new_buffer)
+        else:
+            self.buffer[0:remaining] = bytes(self.view[self.start:self.end])
+        self.start = 0
+        self.end = remaining
+
+    def receive(self, sock):
+        if len(self.buffer) - self.end < len(self.buffer) // 4:
+            self.make_room(self.end - self.start)
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def messages(self):
+        while self.end - self.start >= 4:
+            length = int.from_bytes(self.view[self.start:self.start + 4], byteorder='big') + 4
+            if self.end - self.start < length:
+                if length > len(self.buffer) - self.start:
+                    self.make_room(length)
+                break
+            message = self.view[self.start:self.start + length]
+            self.start += length
+            yield message
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    #The stock QueueHandler formats the message before queueing it. The queue never leaves the
+    #process, so the record can go as it is and the listener formats it.
+    def prepare(self, record):
+        return record
+
+
+class BatchedFileHandler(logging.FileHandler):
+    #Leaves records in the file's buffer instead of flushing after each one, the listener
+    #flushes whenever it has caught up with the queue and the file is flushed on close
+    def flush(self):
+        pass
+
+    def flush_buffer(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    def dequeue(self, block):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush_buffer()
+            return self.queue.get(block)
+
+
+class OutboundQueue():
+    #Send side of one connection. Messages are queued by whichever thread produces them and written
+    #by a thread of the queue's own. Control messages are held for up to FLUSH_DELAY, or until
+    #FLUSH_BYTES of them are waiting or a piece is queued, and then go out together in one sendmsg
+    #call, so a burst of have messages costs one syscall instead of one each. A piece's header rides
+    #in the same call with MSG_MORE and its payload follows with sendfile from the store.
+    #Items are bytes for messages, an index for a piece and (index, offset, length) for a block.
+    FLUSH_BYTES = 16384
+    FLUSH_DELAY = 0.002
+
+    def __init__(self, peer_id: int, conn, piece_store, rate = None, compressor = None):
+        self.peer_id = peer_id
+        self.conn = conn
+        self.piece_store = piece_store
+        #Estimator fed with the piece bytes written, used to rank neighbors when seeding
+        self.rate = rate
+        #CompressedPieceCache when the neighbor negotiated compression, pieces that shrink go out as compressed pieces
+        self.compressor = compressor
+        self.items = collections.deque()
+        #Bytes queued and not yet written, pieces included
+        self.queued_bytes = 0
+        self.queued_pieces = 0
+        self.first_queued = None
+        self.closing = False
+        self.failed = False
+        self.condition = threading.Condition()
+        #Counters for measuring how many send syscalls the traffic took
+        self.sent = SendCounters()
+        self.max_buffers = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+        self.use_sendfile = hasattr(os, "sendfile")
+        #MSG_MORE lets the kernel put a piece header and its payload in the same segment
+        self.more_flag = getattr(socket, "MSG_MORE", 0)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put_message(self, message: bytes):
+        with self.condition:
+            if self.failed or self.closing:
+                return
+            self.items.append(message)
+            self.queued_bytes += len(message)
+            if self.first_queued is None:
+                self.first_queued = time.monotonic()
+                self.condition.notify()
+            elif self.queued_bytes >= self.FLUSH_BYTES:
+                self.condition.notify()
+
+    def put_piece(self, piece_index: int):
+        start, end = self.piece_store.piece_bounds(piece_index)
+        with self.condition:
+            if self.failed or self.closing:
+                return
+            self.items.append(piece_index)
+            self.queued_bytes += end - start + 9
+            self.queued_pieces += 1
+            self.condition.notify()
+
+    def put_block(self, piece_index: int, offset: int, length: int):
+        with self.condition:
+            if self.failed or self.closing:
+                return
+            self.items.append((piece_index, offset, length))
+            self.queued_bytes += length + 13
+            self.queued_pieces += 1
+            self.condition.notify()
+
+    def cancel_piece(self, piece_index: int):
+        #Drops the piece if the writer has not picked it up yet
+        start, end = self.piece_store.piece_bounds(piece_index)
+        with self.condition:
+            if piece_index not in self.items:
+                return False
+            self.items.remove(piece_index)
+            self.queued_bytes -= end - start + 9
+            self.queued_pieces -= 1
+            return True
+
+    def cancel_block(self, piece_index: int, offset: int, length: int):
+        with self.condition:
+            if (piece_index, offset, length) not in self.items:
+                return False
+            self.items.remove((piece_index, offset, length))
+            self.queued_bytes -= length + 13
+            self.queued_pieces -= 1
+            return True
+
+    def close(self, timeout: float):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join(timeout)
+
+    def abort(self):
+        #The connection is gone, whatever is still queued is dropped
+        with self.condition:
+            self.failed = True
+            self.closing = True
+            self.items.clear()
+            self.queued_bytes = 0
+            self.queued_pieces = 0
+            self.condition.notify()
+        self.thread.join(1)
+
+    def take(self):
+        #Waits until something should be written and hands over everything queued, None once closed
+        with self.condition:
+            while True:
+                if self.items:
+                    if self.closing or self.queued_pieces or self.queued_bytes >= self.FLUSH_BYTES:
+                        break
+                    remaining = self.first_queued + self.FLUSH_DELAY - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                elif self.closing:
+                    return None
+                else:
+                    self.condition.wait()
+            items = list(self.items)
+            self.items.clear()
+            self.first_queued = None
+            return items
+
+    def run(self):
+        try:
+            while True:
+                items = self.take()
+                if items is None:
+                    return
+                self.write(items)
+        except OSError as e:
+            logging.info(f"Error: {e}")
+            with self.condition:
+                self.failed = True
+                self.items.clear()
+                self.queued_bytes = 0
+                self.queued_pieces = 0
+
+    def write(self, items):
+        buffers = list()
+        written = 0
+        pieces = 0
+        for item in items:
+            if isinstance(item, bytes):
+                buffers.append(item)
+                self.sent.messages_sent += 1
+                written += len(item)
+                continue
+            if isinstance(item, tuple):
+                piece_index, offset, length = item
+                start = self.piece_store.piece_bounds(piece_index)[0] + offset
+                buffers.append((length + 9).to_bytes(4, byteorder='big') + (11).to_bytes(1, byteorder='big') + piece_index.to_bytes(4, byteorder='big') + offset.to_bytes(4, byteorder='big'))
+                buffers = self.send_range(buffers, start, start + length)
+                written += length + 13
+                self.sent.blocks_sent += 1
+            else:
+                start, end = self.piece_store.piece_bounds(item)
+                compressed = self.compressor.get(item) if self.compressor is not None else None
+                if compressed is not None:
+                    #Sent from memory along with the control messages around it
+                    buffers.append(self.compressor.encode_header(item, len(compressed)))
+                    buffers.append(compressed)
+                    self.sent.compressed_pieces_sent += 1
+                    self.sent.compression_bytes_saved += end - start - len(compressed)
+                else:
+                    buffers.append((end - start + 5).to_bytes(4, byteorder='big') + (7).to_bytes(1, byteorder='big') + item.to_bytes(4, byteorder='big'))
+                    buffers = self.send_range(buffers, start, end)
+                length = end - start
+                written += length + 9
+                self.sent.pieces_sent += 1
+            pieces += 1
+            if self.rate is not None:
+                self.rate.add(length)
+        if buffers:
+            self.send_buffers(buffers)
+        with self.condition:
+            self.queued_bytes -= written
+            self.queued_pieces -= pieces
+
+    def send_range(self, buffers, start: int, end: int):
+        #Sends a range of the store after the buffers ahead of it, returns the buffers still to be sent
+        if not self.use_sendfile:
+            buffers.append(self.piece_store.map[start:end])
+            return buffers
+        self.send_buffers(buffers, self.more_flag)
+        offset = start
+        while offset < end:
+            sent = os.sendfile(self.conn.fileno(), self.piece_store.file.fileno(), offset, end - offset)
+            self.sent.send_calls += 1
+            if sent == 0:
+                raise ConnectionError(f"Connection to {self.peer_id} closed while sending bytes {start} to {end} of the file")
+            offset += sent
+        self.sent.bytes_sent += end - start
+        return list()
+
+    def send_buffers(self, buffers, flags: int = 0):
+        #One gather write per IOV_MAX buffers, picking up after a partial write
+        if len(buffers) == 1:
+            self.conn.sendall(buffers[0], flags)
+            self.sent.send_calls += 1
+            self.sent.bytes_sent += len(buffers[0])
+            return
+        pending = collections.deque(memoryview(buffer) for buffer in buffers)
+        while pending:
+            batch = list(itertools.islice(pending, self.max_buffers))
+            if hasattr(self.conn, "sendmsg"):
+                sent = self.conn.sendmsg(batch, [], flags)
+            else:
+                sent = self.conn.send(b"".join(batch), flags)
+            self.sent.send_calls += 1
+            self.sent.bytes_sent += sent
+            while sent > 0:
+                if sent >= len(pending[0]):
+                    sent -= len(pending.popleft())
+                else:
+                    pending[0] = pending[0][sent:]
+                    sent = 0
+
+
+class UploadTally():
+    #Stands in for a RateEstimator in a worker process, the piece bytes are added to the peer's estimator from reports
+    def __init__(self):
+        self.total = 0
+
+    def add(self, num_bytes: int):
+        self.total += num_bytes
+
+
+class WorkerConnection():
+    #Peer side of a connection served by an upload worker, in place of its OutboundQueue. Messages are
+    #passed on to the worker, which writes them in order with the pieces, and the counters come from its reports.
+    def __init__(self, worker, peer_id: int):
+        self.worker = worker
+        self.peer_id = peer_id
+        self.sent = SendCounters()
+        self.queued_bytes = 0
+        self.uploaded = 0
+        self.bytes_received = 0
+
+    def put_message(self, message: bytes):
+        self.worker.send(WORKER_SEND, self.peer_id, message)
+
+    def close(self, timeout: float):
+        self.worker.stop(timeout)
+
+    def abort(self):
+        #The worker has already dropped its side of the connection
+        self.worker.connections.pop(self.peer_id, None)
+
+    def update(self, report):
+        #Returns how many more piece bytes the worker has sent since the last report
+        self.sent.update(report["sent"])
+        self.queued_bytes = report["queued_bytes"]
+        self.bytes_received = report["bytes_received"]
+        uploaded, self.uploaded = report["uploaded"] - self.uploaded, report["uploaded"]
+        return uploaded
+
+
+class UploadWorker():
+    #Peer side of one upload worker process. A neighbor's socket is passed to the worker over a Unix
+    #socket once its handshake is done, and from then on the worker does all the reading and writing on it.
+    #The worker serves requests, block requests and cancels itself from a read-only mapping of the file,
+    #and only while the last choke message it wrote to the neighbor was an unchoke, so choking stays here.
+    #Everything else the neighbor sends comes back to be handled by read_message.
+
+    def __init__(self, peer_process, compression: bool, cache_budget: int):
+        self.peer_process = peer_process
+        self.channel, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        #Spawned rather than forked, the peer already runs threads
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(target=run_upload_worker, daemon=True,
+                                       args=(child, peer_process.piece_store.path, peer_process.file_size, peer_process.piece_size,
+                                             peer_process.outbound_limit, compression, cache_budget, peer_process.max_msg_size))
+        self.process.start()
+        child.close()
+        self.connections = dict()
+        self.stopped = False
+
+    def attach(self, peer_id: int, conn, capabilities: int):
+        socket.send_fds(self.channel, [worker_packet(WORKER_ATTACH, peer_id, capabilities.to_bytes(1, byteorder='big'))], [conn.fileno()])
+        self.connections[peer_id] = WorkerConnection(self, peer_id)
+        return self.connections[peer_id]
+
+    def send(self, kind: int, peer_id: int, payload = b""):
+        if not self.stopped:
+            self.channel.send(worker_packet(kind, peer_id, payload))
+
+    def receive(self):
+        #Called from the receive loop when the worker has sent something
+        try:
+            packet = self.channel.recv(WORKER_PACKET_LIMIT)
+        except ConnectionResetError:
+            packet = b""
+        peer_process = self.peer_process
+        if not packet:
+            logging.info(f"Error: Upload worker {self.process.pid} of Peer {peer_process.id} exited")
+            #Its neighbors lost their connections with it. They are dropped and redialed, and served by
+            #the remaining workers, or read here once none are left.
+            self.stopped = True
+            peer_process.sockets_list.remove(self.channel)
+            del peer_process.worker_channels[self.channel.fileno()]
+            with peer_process.state_lock:
+                peer_process.upload_workers.remove(self)
+                for peer_id, connection in list(self.connections.items()):
+                    if peer_process.outbound.get(peer_id) is connection:
+                        peer_process.drop_neighbor(peer_id)
+                self.connections.clear()
+            self.process.join(1)
+            self.channel.close()
+            return
+        with peer_process.state_lock:
+            self.handle(packet, True)
+
+    def handle(self, packet, dispatch: bool):
+        kind = packet[0]
+        peer_id = int.from_bytes(packet[1:5], byteorder='big')
+        payload = memoryview(packet)[5:]
+        peer_process = self.peer_process
+        if kind == WORKER_REPORT:
+            connection = self.connections.get(peer_id)
+            if connection is None:
+                return
+            report = json.loads(bytes(payload))
+            uploaded = connection.update(report)
+            peer_process.upload_rates[peer_id].add(uploaded)
+            peer_process.metrics.neighbors[peer_id].bytes_received = self.connections[peer_id].bytes_received
+        elif kind == WORKER_SERVED:
+            if peer_process.super_seeding and peer_id in peer_process.peers_info:
+                for offset in range(0, len(payload), 4):
+                    piece_index = int.from_bytes(payload[offset:offset + 4], byteorder='big')
+                    peer_process.superseed_given.setdefault(piece_index, set()).add(peer_id)
+        elif kind == WORKER_RECEIVED and dispatch:
+            offset = 0
+            while offset < len(payload):
+                length = int.from_bytes(payload[offset:offset + 4], byteorder='big') + 4
+                peer_process.read_message(peer_id, payload[offset:offset + length])
+                offset += length
+        elif kind == WORKER_CLOSED and dispatch:
+            #A neighbor that has connected again since is served by a new WorkerConnection, maybe of another worker
+            connection = self.connections.get(peer_id)
+            if connection is not None and peer_process.outbound.get(peer_id) is connection:
+                peer_process.drop_neighbor(peer_id)
+
+    def stop(self, timeout: float):
+        #Lets the worker write out what is still queued and applies its last reports
+        if self.stopped:
+            return
+        self.send(WORKER_STOP, 0)
+        self.stopped = True
+        deadline = time.monotonic() + timeout
+        while True:
+            readable, _, _ = select.select([self.channel], [], [], max(0, deadline - time.monotonic()))
+            if not readable:
+                break
+            try:
+                packet = self.channel.recv(WORKER_PACKET_LIMIT)
+            except ConnectionResetError:
+                break
+            if not packet:
+                break
+            self.handle(packet, False)
+        self.process.join(max(0, deadline - time.monotonic()))
+        self.channel.close()
+
+
+def run_upload_worker(channel, path: str, file_size: int, piece_size: int, outbound_limit: int, compression: bool, cache_budget: int, max_msg_size: int):
+    UploadWorkerProcess(channel, path, file_size, piece_size, outbound_limit, compression, cache_budget, max_msg_size).run()
+
+
+class UploadWorkerProcess():
+    #Runs in the worker process. Each attached connection gets a MessageFramer and an OutboundQueue as it
+    #would in the peer, pieces go out with sendfile from the worker's own read-only mapping of the file.
+    #Packets to the peer are sent from a thread of their own so the worker never blocks on the peer
+    #while the peer is blocked sending to it.
+    REPORT_INTERVAL = 0.05
+
+    def __init__(self, channel, path: str, file_size: int, piece_size: int, outbound_limit: int, compression: bool, cache_budget: int, max_msg_size: int):
+        self.channel = channel
+        self.piece_store = PieceStore(path, file_size, piece_size, True)
+        #Compression follows the peer's setting even with no budget, the pieces are then compressed on every upload as the peer would
+        self.compressed_pieces = CompressedPieceCache(self.piece_store, cache_budget) if compression else None
+        self.outbound_limit = outbound_limit
+        self.max_msg_size = max_msg_size
+        self.connections = dict()
+        #Sockets still being read, a closed connection is only dropped from here
+        self.reading = list()
+        self.socket_peers = dict()
+        self.framers = dict()
+        self.outbound = dict()
+        self.tallies = dict()
+        self.bytes_received = dict()
+        #Neighbors whose last choke message was an unchoke, and pieces served to each since the last report
+        self.unchoked = set()
+        self.served = dict()
+        self.reported = dict()
+        self.packets = queue.SimpleQueue()
+        self.sender = threading.Thread(target=self.send_packets, daemon=True)
+        self.sender.start()
+
+    def send_packets(self):
+        while True:
+            packet = self.packets.get()
+            if packet is None:
+                return
+            self.channel.send(packet)
+
+    def run(self):
+        next_report = time.monotonic() + self.REPORT_INTERVAL
+        try:
+            while True:
+                readable, _, _ = select.select([self.channel] + self.reading, [], [], self.REPORT_INTERVAL)
+                for sock in readable:
+                    if sock is self.channel:
+                        if not self.control():
+                            return
+                    else:
+                        self.receive(self.socket_peers[sock.fileno()])
+                if time.monotonic() >= next_report:
+                    self.report()
+                    next_report = time.monotonic() + self.REPORT_INTERVAL
+        finally:
+            deadline = time.monotonic() + 5
+            for outbound in self.outbound.values():
+                outbound.close(max(0, deadline - time.monotonic()))
+            self.report()
+            self.packets.put(None)
+            self.sender.join()
+            for conn in self.connections.values():
+                conn.close()
+            self.channel.close()
+            self.piece_store.close()
+
+    def control(self):
+        packet, fds, _, _ = socket.recv_fds(self.channel, WORKER_PACKET_LIMIT, 1)
+        if not packet:
+            return False
+        kind = packet[0]
+        peer_id = int.from_bytes(packet[1:5], byteorder='big')
+        if kind == WORKER_ATTACH:
+            conn = socket.socket(fileno=fds[0])
+            conn.setblocking(True)
+            compressor = self.compressed_pieces if packet[5] & CAPABILITY_COMPRESSION else None
+            self.tallies[peer_id] = UploadTally()
+            self.connections[peer_id] = conn
+            self.reading.append(conn)
+            self.socket_peers[conn.fileno()] = peer_id
+            self.framers[peer_id] = MessageFramer(self.max_msg_size)
+            self.outbound[peer_id] = OutboundQueue(peer_id, conn, self.piece_store, self.tallies[peer_id], compressor)
+            self.bytes_received[peer_id] = 0
+            self.served[peer_id] = list()
+        elif kind == WORKER_SEND:
+            if peer_id not in self.outbound:
+                #Sent before the peer learned the connection was closed
+                return True
+            message = packet[5:]
+            if message[4] == 0:
+                self.unchoked.discard(peer_id)
+            elif message[4] == 1:
+                self.unchoked.add(peer_id)
+            self.outbound[peer_id].put_message(message)
+        elif kind == WORKER_STOP:
+            return False
+        return True
+
+    def receive(self, peer_id: int):
+        conn = self.connections[peer_id]
+        framer = self.framers[peer_id]
+        try:
+            received = framer.receive(conn)
+        except ConnectionResetError:
+            received = 0
+        if received == 0:
+            self.drop(peer_id)
+            self.packets.put(worker_packet(WORKER_CLOSED, peer_id))
+            return
+        self.bytes_received[peer_id] += received
+        forwarded = list()
+        for message in framer.messages():
+            if self.serve(peer_id, message):
+                continue
+            if len(message) + 5 > WORKER_PACKET_LIMIT:
+                #Only a piece or a block can be this large, and the peer ignores those as a seed
+                continue
+            forwarded.append(bytes(message))
+        if forwarded:
+            #A have for a piece served here must not reach the peer before the peer knows it was given
+            self.send_served(peer_id)
+            batch = list()
+            size = 5
+            for message in forwarded:
+                if size + len(message) > WORKER_PACKET_LIMIT:
+                    self.packets.put(worker_packet(WORKER_RECEIVED, peer_id, b"".join(batch)))
+                    batch = list()
+                    size = 5
+                batch.append(message)
+                size += len(message)
+            self.packets.put(worker_packet(WORKER_RECEIVED, peer_id, b"".join(batch)))
+
+    def drop(self, peer_id: int):
+        #Pieces served to the neighbor are still handed back, the peer drops everything else about it
+        self.send_served(peer_id)
+        conn = self.connections.pop(peer_id)
+        self.reading.remove(conn)
+        del self.socket_peers[conn.fileno()]
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.outbound.pop(peer_id).abort()
+        conn.close()
+        for table in (self.framers, self.tallies, self.bytes_received, self.served, self.reported):
+            table.pop(peer_id, None)
+        self.unchoked.discard(peer_id)
+
+    def serve(self, peer_id: int, message):
+        #Returns whether the message was handled here, the same checks as read_message makes for a seed
+        msg_type = message[4]
+        outbound = self.outbound[peer_id]
+        try:
+            if msg_type == 6:
+                piece_index = int.from_bytes(message[5:9], byteorder='big')
+                self.piece_store.piece_bounds(piece_index)
+                if peer_id in self.unchoked and outbound.queued_bytes <= self.outbound_limit:
+                    outbound.put_piece(piece_index)
+                    self.served[peer_id].append(piece_index)
+            elif msg_type == 10:
+                piece_index = int.from_bytes(message[5:9], byteorder='big')
+                offset = int.from_bytes(message[9:13], byteorder='big')
+                length = int.from_bytes(message[13:17], byteorder='big')
+                start, end = self.piece_store.piece_bounds(piece_index)
+                if length == 0 or offset + length > end - start:
+                    raise ValueError(f"Requested block at {offset} of piece {piece_index} is not in this peer")
+                if peer_id in self.unchoked and outbound.queued_bytes <= self.outbound_limit:
+                    outbound.put_block(piece_index, offset, length)
+                    self.served[peer_id].append(piece_index)
+            elif msg_type == 8:
+                piece_index = int.from_bytes(message[5:9], byteorder='big')
+                if len(message) == 17:
+                    outbound.cancel_block(piece_index, int.from_bytes(message[9:13], byteorder='big'), int.from_bytes(message[13:17], byteorder='big'))
+                else:
+                    outbound.cancel_piece(piece_index)
+            else:
+                return False
+        except ValueError:
+            #A request outside of the file, ignored as the peer would
+            pass
+        return True
+
+    def send_served(self, peer_id: int):
+        served = self.served[peer_id]
+        per_packet = (WORKER_PACKET_LIMIT - 5) // 4
+        for start in range(0, len(served), per_packet):
+            self.packets.put(worker_packet(WORKER_SERVED, peer_id, b"".join(piece_index.to_bytes(4, byteorder='big') for piece_index in served[start:start + per_packet])))
+        served.clear()
+
+    def report(self):
+        for peer_id, outbound in self.outbound.items():
+            self.send_served(peer_id)
+            counters = {"sent": outbound.sent.snapshot(), "queued_bytes": outbound.queued_bytes,
+                        "uploaded": self.tallies[peer_id].total, "bytes_received": self.bytes_received[peer_id]}
+            if counters == self.reported.get(peer_id):
+                continue
+            self.reported[peer_id] = counters
+            #Reports are JSON so counters are matched up by name on the peer's side
+            self.packets.put(worker_packet(WORKER_REPORT, peer_id, json.dumps(counters).encode()))
+
+
+class LoopScheduler():
+    #Same interface as Scheduler, backed by the event loop's timers for the asyncio engine
+    def __init__(self, loop):
+        self.loop = loop
+        self.handles = set()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        for handle in list(self.handles):
+            handle.cancel()
+        self.handles.clear()
+
+    def call_later(self, delay: float, function, *args):
+        handle = None
+        def fire():
+            self.handles.discard(handle)
+            try:
+                function(*args)
+            except Exception as e:
+                logging.info(f"Error: {e}")
+        handle = self.loop.call_later(delay, fire)
+        self.handles.add(handle)
+        return handle
+
+    def cancel(self, handle):
+        handle.cancel()
+        self.handles.discard(handle)
+
+    def pending(self):
+        return len(self.handles)
+
+
+class ScheduledTask():
+    def __init__(self, due: float, function, args):
+        self.due = due
+        self.function = function
+        self.args = args
+        #Set once the task is cancelled or has been taken off the heap to run
+        self.done = False
+
+
+class Scheduler():
+    #One thread runs every delayed task of a peer (request timeouts and unchoking rounds) in due
+    #order from a heap, instead of a threading.Timer thread per task. Cancelled tasks stay in
+    #the heap until they come up or until they make up most of it, then the heap is rebuilt.
+    def __init__(self, lock = None):
+        self.lock = lock if lock is not None else threading.RLock()
+        self.heap = list()
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.num_cancelled = 0
+        self.running = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def call_later(self, delay: float, function, *args):
+        task = ScheduledTask(time.monotonic() + delay, function, args)
+        with self.condition:
+            heapq.heappush(self.heap, (task.due, next(self.sequence), task))
+            if self.heap[0][2] is task:
+                self.condition.notify()
+        return task
+
+    def cancel(self, task: ScheduledTask):
+        with self.condition:
+            if task.done:
+                return
+            task.done = True
+            self.num_cancelled += 1
+            if self.num_cancelled > 64 and self.num_cancelled * 2 > len(self.heap):
+                self.heap = [entry for entry in self.heap if not entry[2].done]
+                heapq.heapify(self.heap)
+                self.num_cancelled = 0
+
+    def pending(self):
+        with self.condition:
+            return len(self.heap) - self.num_cancelled
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if not self.running:
+                    return
+                _, _, task = heapq.heappop(self.heap)
+                if task.done:
+                    self.num_cancelled -= 1
+                    continue
+                task.done = True
+            with self.lock:
+                try:
+                    task.function(*task.args)
+                except Exception as e:
+                    #Every timer of the peer lives on this thread, so one failing task must not stop it
+                    logging.info(f"Error: {e}")
+
+
+class RateEstimator():
+    #Bytes per second as an exponential moving average. Bytes are added as they are transferred, from
+    #whichever thread moves them, and folded into the average on update() divided by the time since
+    #the previous update, with a weight that decays over window seconds whatever the update spacing.
+    def __init__(self, window: float):
+        self.window = max(window, 0.001)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.rate = 0.0
+        self.last_update = time.monotonic()
+
+    def add(self, num_bytes: int):
+        with self.lock:
+            self.pending += num_bytes
+
+    def update(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            elapsed = now - self.last_update
+            if elapsed <= 0:
+                return self.rate
+            weight = 1 - math.exp(-elapsed / self.window)
+            self.rate += weight * (self.pending / elapsed - self.rate)
+            self.pending = 0
+            self.last_update = now
+            return self.rate
+
+
+class LatencyHistogram():
+    #Cumulative-style histogram with fixed bucket bounds in seconds, observing is one bisect and an increment
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def snapshot(self):
+        buckets = list()
+        running = 0
+        for bound, count in zip(self.BOUNDS + (float("inf"),), self.counts):
+            running += count
+            buckets.append(["+Inf" if bound == float("inf") else bound, running])
+        return {"count": self.count, "sum": self.total, "buckets": buckets}
+
+
+class SendCounters():
+    #What has been written to one neighbor, kept by whichever sender serves the connection: an
+    #OutboundQueue, the asyncio write loop, or an upload worker which reports them by name
+    FIELDS = ("bytes_sent", "pieces_sent", "messages_sent", "send_calls", "compressed_pieces_sent", "compression_bytes_saved", "blocks_sent")
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def snapshot(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def update(self, values):
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field, 0))
+
+
+class NeighborMetrics():
+    def __init__(self):
+        self.bytes_received = 0
+        self.pieces_received = 0
+        self.compressed_pieces_received = 0
+        self.blocks_received = 0
+        self.chokes_received = 0
+        self.unchokes_received = 0
+        self.chokes_sent = 0
+        self.unchokes_sent = 0
+
+
+class PeerMetrics():
+    #Plain counters bumped on the message paths. Everything that can be read off the peer's state
+    #when a snapshot is taken (queue depths, timers, choke state) is not counted here.
+    def __init__(self):
+        self.started = time.monotonic()
+        self.neighbors = dict()
+        self.request_latency = LatencyHistogram()
+
+    def add_neighbor(self, peer_id: int):
+        if peer_id not in self.neighbors:
+            self.neighbors[peer_id] = NeighborMetrics()
+
+    def count_choke_sent(self, peer_id: int, msg_type: int):
+        if msg_type == 0:
+            self.neighbors[peer_id].chokes_sent += 1
+        else:
+            self.neighbors[peer_id].unchokes_sent += 1
+
+
+class PartialPiece():
+    #Blocks of a piece being fetched block by block, possibly from several neighbors at once.
+    #Received and requested blocks are bitsets over the piece's blocks, and each requested block
+    #maps to the neighbors it was asked from, more than one only during endgame.
+    def __init__(self, num_blocks: int):
+        self.num_blocks = num_blocks
+        self.all_blocks = (1 << num_blocks) - 1
+        self.received = 0
+        self.requested = 0
+        self.askers = dict()
+        #Neighbors that sent some of the blocks, blamed together if the piece fails verification
+        self.senders = set()
+
+    def open_blocks(self):
+        return self.all_blocks & ~(self.received | self.requested)
+
+    def complete(self):
+        return self.received == self.all_blocks
+
+
+class PiecePicker():
+    #Rarest-first piece selection. Pieces are grouped into levels by how many neighbors hold them,
+    #each level being a bitset, and the levels in use are kept in a sorted list. Each piece's count
+    #is also kept in an array, so a 'have' moves that one bit between two adjacent levels, while a
+    #bitfield moves whole bitsets. Picking walks the levels from the rarest up until one intersects
+    #the candidates. Each level tried costs an AND over num_pieces bits and random_set_bit costs about
+    #two more passes, so a pick is linear in num_pieces (a machine word at a time) times the levels
+    #tried. Only keeping the levels in order is logarithmic.
+    def __init__(self, num_pieces: int, random_first_pieces: int = 4):
+        self.num_pieces = num_pieces
+        #Until this many pieces are held, pick at random so there is something to trade quickly
+        self.random_first_pieces = random_first_pieces
+        self.levels = {0: (1 << num_pieces) - 1} if num_pieces > 0 else dict()
+        self.sorted_levels = sorted(self.levels)
+        self.counts = array.array('H', bytes(2 * num_pieces))
+        #Byte order of the counts array, and where the low byte of each count sits
+        self.count_order = 'little' if array.array('H', [1]).tobytes()[0] else 'big'
+        self.low_byte = 0 if self.count_order == 'little' else 1
+
+    def move_to_level(self, count: int, bits: int):
+        if count not in self.levels:
+            self.levels[count] = 0
+            bisect.insort(self.sorted_levels, count)
+        self.levels[count] |= bits
+
+    def clear_level(self, count: int):
+        if not self.levels[count]:
+            del self.levels[count]
+            self.sorted_levels.remove(count)
+
+    def shift(self, mask: int, step: int):
+        #Moves every piece in mask up or down one level. The moves are collected first so
+        #a piece that lands in a level is not moved again by the same call.
+        moves = list()
+        all_moved = 0
+        for count in self.sorted_levels:
+            moved = self.levels[count] & mask
+            if moved and count + step >= 0:
+                self.levels[count] ^= moved
+                moves.append((count + step, moved))
+                all_moved |= moved
+        for count, moved in moves:
+            self.move_to_level(count, moved)
+        if all_moved:
+            #Adds or subtracts one in every moved piece's count at once, treating the counts
+            #array as one integer of 16-bit lanes. No lane over- or underflows, so no carry
+            #crosses into a neighboring count.
+            digits = bin(all_moved)[:1:-1].encode().translate(BINARY_DIGITS)
+            delta = bytearray(2 * self.num_pieces)
+            delta[self.low_byte:self.low_byte + 2 * len(digits):2] = digits
+            delta = int.from_bytes(delta, self.count_order)
+            counts = int.from_bytes(self.counts, self.count_order)
+            counts = counts + delta if step > 0 else counts - delta
+            self.counts = array.array('H', counts.to_bytes(2 * self.num_pieces, self.count_order))
+        for count in [count for count in self.sorted_levels if not self.levels[count]]:
+            self.clear_level(count)
+
+    def add_availability(self, mask: int):
+        if mask:
+            self.shift(mask, 1)
+
+    def remove_availability(self, mask: int):
+        if mask:
+            self.shift(mask, -1)
+
+    def add_piece(self, piece_index: int):
+        #A 'have' for one piece, only that piece's bit changes level
+        count = self.counts[piece_index]
+        bit = 1 << piece_index
+        self.levels[count] ^= bit
+        self.move_to_level(count + 1, bit)
+        self.counts[piece_index] = count + 1
+        self.clear_level(count)
+
+    def availability(self, piece_index: int):
+        return self.counts[piece_index]
+
+    def pick(self, candidates: int, num_pieces_held: int):
+        #Returns the rarest of the candidate pieces, ties broken at random
+        if not candidates:
+            return None
+        if num_pieces_held < self.random_first_pieces:
+            return random_set_bit(candidates)
+        for count in self.sorted_levels:
+            matches = self.levels[count] & candidates
+            if matches:
+                return random_set_bit(matches)
+        return random_set_bit(candidates)
+
+
+class PieceManifest():
+    #Per-piece hashes of the shared file. On disk it is a header line "<algorithm> <piece size> <file size>"
+    #followed by one hex digest per piece, generated once from the seed's copy of the file.
+    def __init__(self, algorithm: str, piece_size: int, file_size: int, digests):
+        self.algorithm = algorithm
+        self.piece_size = piece_size
+        self.file_size = file_size
+        self.digests = digests
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "r") as file:
+            words = file.readline().split()
+            if len(words) != 3 or words[0] not in hashlib.algorithms_available:
+                raise ValueError(f"Manifest {path} has an invalid header")
+            digests = [bytes.fromhex(line.strip()) for line in file if line.strip()]
+        manifest = cls(words[0], int(words[1]), int(words[2]), digests)
+        if len(digests) != math.ceil(manifest.file_size / manifest.piece_size):
+            raise ValueError(f"Manifest {path} does not list a hash for every piece")
+        return manifest
+
+    @classmethod
+    def build(cls, piece_store, pool, algorithm: str = "sha256"):
+        num_pieces = math.ceil(piece_store.file_size / piece_store.piece_size)
+        digests = list(pool.map(lambda piece_index: cls.digest(algorithm, piece_store, piece_index), range(num_pieces)))
+        return cls(algorithm, piece_store.piece_size, piece_store.file_size, digests)
+
+    @staticmethod
+    def digest(algorithm: str, piece_store, piece_index: int):
+        view = piece_store.piece_view(piece_index)
+        try:
+            return hashlib.new(algorithm, view).digest()
+        finally:
+            view.release()
+
+    def write(self, path: str):
+        with open(path, "w") as file:
+            file.write(f"{self.algorithm} {self.piece_size} {self.file_size}\n")
+            for digest in self.digests:
+                file.write(digest.hex() + "\n")
+
+    def check(self, piece_store, piece_index: int):
+        return self.digest(self.algorithm, piece_store, piece_index) == self.digests[piece_index]
+
+    def check_pieces(self, piece_store, pool, mask: int):
+        #Returns the subset of the pieces in mask whose hashes match
+        piece_indices = [piece_index for piece_index in range(len(self.digests)) if (mask >> piece_index) & 1]
+        results = pool.map(lambda piece_index: self.check(piece_store, piece_index), piece_indices)
+        return sum(1 << piece_index for piece_index, ok in zip(piece_indices, results) if ok)
+
+
+class PieceCheckpoint():
+    #Record in peer_{id}/ of the pieces this peer has stored, so a restarted peer can rebuild its
+    #bitfield. A 12 byte header holds the piece and file size, then every stored piece appends its
+    #4 byte index with a single unbuffered write. Piece data goes through the shared mapping first,
+    #so it is already in the page cache by the time its index is recorded.
+    def __init__(self, path: str, piece_size: int, file_size: int):
+        self.path = path
+        self.header = piece_size.to_bytes(4, byteorder='big') + file_size.to_bytes(8, byteorder='big')
+        self.existed = os.path.exists(path)
+        self.fd = None
+
+    def load(self):
+        if not self.existed:
+            return 0
+        with open(self.path, "rb") as file:
+            content = file.read()
+        if content[0:len(self.header)] != self.header:
+            #Written for a different file
+            return 0
+        mask = 0
+        #A torn last entry from a crash is shorter than 4 bytes and ignored
+        for offset in range(len(self.header), len(content) - 3, 4):
+            mask |= 1 << int.from_bytes(content[offset:offset + 4], byteorder='big')
+        return mask
+
+    def rewrite(self, mask: int):
+        entries = b"".join(piece_index.to_bytes(4, byteorder='big') for piece_index in range(mask.bit_length()) if (mask >> piece_index) & 1)
+        with open(f"{self.path}.tmp", "wb") as file:
+            file.write(self.header + entries)
+        os.replace(f"{self.path}.tmp", self.path)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+    def record(self, piece_index: int):
+        if self.fd is not None:
+            os.write(self.fd, piece_index.to_bytes(4, byteorder='big'))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class CompressedPieceCache():
+    #Compressed form of the pieces uploaded or received lately, shared by all connections, so a hot
+    #piece is compressed once however many neighbors request it. Compressed pieces are evicted least
+    #recently used first once they add up to more than the byte budget. Pieces that do not shrink by
+    #at least MIN_SAVING, such as already compressed media, are remembered in a set of their own that
+    #is not evicted, and sent raw. A SAMPLE_SIZE slice from the middle of the piece is tried first, so
+    #those pieces cost a fraction of a full pass. Raw pieces are not held here at all, they are sent
+    #with sendfile straight from the store, which the page cache already keeps in memory.
+    LEVEL = 1
+    MIN_SAVING = 0.1
+    SAMPLE_SIZE = 4096
+    MISSING = object()
+
+    def __init__(self, piece_store, budget: int):
+        self.piece_store = piece_store
+        self.budget = budget
+        self.pieces = collections.OrderedDict()
+        self.incompressible = set()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        #Lookups answered from the cache, lookups of pieces known not to shrink, pieces that had to be
+        #compressed, and the piece bytes the hits did not compress again
+        self.hits = 0
+        self.incompressible_lookups = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def cached(self, piece_index: int):
+        with self.lock:
+            if piece_index in self.incompressible:
+                self.incompressible_lookups += 1
+                return None
+            compressed = self.pieces.get(piece_index, self.MISSING)
+            if compressed is not self.MISSING:
+                self.pieces.move_to_end(piece_index)
+                self.hits += 1
+                start, end = self.piece_store.piece_bounds(piece_index)
+                self.bytes_saved += end - start
+            return compressed
+
+    def get(self, piece_index: int):
+        compressed = self.cached(piece_index)
+        if compressed is not self.MISSING:
+            return compressed
+        #zlib releases the GIL, so writers compressing different pieces run in parallel
+        view = self.piece_store.piece_view(piece_index)
+        try:
+            compressed = None
+            middle = max(0, (len(view) - self.SAMPLE_SIZE) // 2)
+            if self.shrinks(view[middle:middle + self.SAMPLE_SIZE]):
+                compressed = zlib.compress(view, self.LEVEL)
+                if len(compressed) > len(view) * (1 - self.MIN_SAVING):
+                    compressed = None
+        finally:
+            view.release()
+        with self.lock:
+            self.misses += 1
+        self.put(piece_index, compressed)
+        return compressed
+
+    def put(self, piece_index: int, compressed):
+        #Also called with pieces received compressed once they are verified, so they are served on without compressing them again
+        with self.lock:
+            if compressed is None:
+                self.incompressible.add(piece_index)
+                return
+            if piece_index in self.pieces or len(compressed) > self.budget:
+                return
+            self.pieces[piece_index] = compressed
+            self.cached_bytes += len(compressed)
+            while self.cached_bytes > self.budget:
+                _, evicted = self.pieces.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+                self.evictions += 1
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "budget_bytes": self.budget,
+                "cached_bytes": self.cached_bytes,
+                "cached_pieces": len(self.pieces),
+                "incompressible_pieces": len(self.incompressible),
+                "hits": self.hits,
+                "incompressible_lookups": self.incompressible_lookups,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "bytes_saved": self.bytes_saved,
+            }
+
+    def shrinks(self, data):
+        return len(zlib.compress(data, self.LEVEL)) <= len(data) * (1 - self.MIN_SAVING)
+
+    def encode_header(self, piece_index: int, compressed_length: int):
+        return (compressed_length + 5).to_bytes(4, byteorder='big') + (9).to_bytes(1, byteorder='big') + piece_index.to_bytes(4, byteorder='big')
+
+
+class PieceStore():
+    #Backing storage for the shared file. The target file is allocated at its full size once and
+    #memory-mapped, pieces are written straight to their offset and later reads come from the same
+    #mapping, so there are no per-piece files and no reassembly once the download finishes.
+    def __init__(self, path: str, file_size: int, piece_size: int, read_only: bool):
+        self.path = path
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.read_only = read_only
+        self.existed = os.path.exists(path)
+        if read_only:
+            self.file = open(path, "rb")
+            if os.fstat(self.file.fileno()).st_size != file_size:
+                self.file.close()
+                raise RuntimeError(f"File {path} does not match the configured size of {file_size} bytes")
+        else:
+            #An existing file is kept as is so pieces already on disk are not thrown away
+            self.file = open(path, "r+b" if self.existed else "w+b")
+            if os.fstat(self.file.fileno()).st_size != file_size:
+                #A file of another size is not an earlier download of this one
+                self.existed = False
+                self.file.truncate(file_size)
+                self.preallocate()
+        access = mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE
+        self.map = mmap.mmap(self.file.fileno(), file_size, access=access)
+
+    def preallocate(self):
+        #Reserve the blocks up front where the platform allows it, otherwise the file stays sparse.
+        #Either way the disk only ever holds one copy of the data.
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.file.fileno(), 0, self.file_size)
+            except OSError:
+                pass
+
+    def piece_bounds(self, piece_index: int):
+        start = piece_index * self.piece_size
+        if piece_index < 0 or start >= self.file_size:
+            raise ValueError(f"Piece {piece_index} is outside of the file")
+        return start, min(start + self.piece_size, self.file_size)
+
+    def write_piece(self, piece_index: int, data):
+        start, end = self.piece_bounds(piece_index)
+        if len(data) != end - start:
+            raise ValueError(f"Piece {piece_index} should be {end - start} bytes but {len(data)} were received")
+        self.map[start:end] = data
+
+    def write_block(self, piece_index: int, offset: int, data):
+        start, end = self.piece_bounds(piece_index)
+        if offset + len(data) > end - start:
+            raise ValueError(f"Block at {offset} of piece {piece_index} runs past the end of the piece")
+        self.map[start + offset:start + offset + len(data)] = data
+
+    def read_piece(self, piece_index: int):
+        start, end = self.piece_bounds(piece_index)
+        return self.map[start:end]
+
+    def piece_view(self, piece_index: int):
+        #Zero-copy view of the piece in the mapping, must be released before the store is closed
+        start, end = self.piece_bounds(piece_index)
+        return memoryview(self.map)[start:end]
+
+    def flush(self):
+        if not self.read_only:
+            self.map.flush()
+
+    def close(self):
+        self.flush()
+        self.map.close()
+        self.file.close()
+
+
 class PeerInfo():
     def __init__(self, peer_id, host_name, port_num, has_file):
         self.peer_id = int(peer_id)
         self.host_name = host_name
         self.port_num = int(port_num)
         self.has_file = has_file == '1'
-        self.bitfield = None
-        self.interesting_pieces = list()
+        self.have_mask = 0
+        #Pieces we told this neighbor we have, only tracked while super-seeding
+        self.announced_mask = 0
+        #Whether we last told this neighbor we are interested in it
+        self.interested_in_them = False
+        self.outstanding_requests = set()
+        #Blocks requested from this neighbor, as (piece index, block index)
+        self.outstanding_blocks = set()
+        #Capability bits both sides advertised in the handshake
+        self.capabilities = 0
+        #Pieces this neighbor sent that failed verification
+        self.bad_pieces = 0
         self.interested_in_me = False
         
 
@@ -440,14 +3005,25 @@ class PeerInfo():
 
 
 def main():
-    if len(sys.argv) < 2:
-        raise SyntaxError("Need to provide a peer ID argument")
-    id = int(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Peer of the P2P file sharing project")
+    parser.add_argument("peer_id", type=int, help="ID of this peer in PeerInfo.cfg")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="threaded uses a select loop plus helper threads, asyncio runs every connection on one event loop")
+    args = parser.parse_args()
+    id = args.peer_id
     host_name = None
     port = None
     has_file = None
     prev_peers = list()
     next_peers = list()
+    request_pipeline_depth = 1
+    endgame = True
+    metrics_interval = 0
+    compression = True
+    piece_cache_size = 64*2**20
+    block_size = 16384
+    super_seeding = False
+    upload_workers = 0
 
     # Get previous peers and this peer's port number
     with open('PeerInfo.cfg', 'r') as file:
@@ -501,60 +3077,68 @@ def main():
                     file_size = int(val)
                 case 'PieceSize':
                     piece_size = int(val)
+                case 'RequestPipelineDepth':
+                    request_pipeline_depth = int(val)
+                case 'EndgameMode':
+                    endgame = val == '1'
+                case 'MetricsInterval':
+                    metrics_interval = int(val)
+                case 'PieceCompression':
+                    compression = val == '1'
+                case 'PieceCacheSize':
+                    piece_cache_size = int(val)
+                case 'BlockSize':
+                    block_size = int(val)
+                case 'SuperSeeding':
+                    super_seeding = val == '1'
+                case 'UploadWorkers':
+                    upload_workers = int(val)
                 case _:
                     raise ValueError(f"Unrecognized key: {key}")
         
+    if args.engine == "asyncio":
+        peer = AsyncPeerProcess(id, host_name, port, has_file, num_pref_nbors, unchoke_int, opt_unchoke_int, file_name, file_size, piece_size, next_peers, request_pipeline_depth, endgame, metrics_interval, compression, piece_cache_size, block_size, super_seeding)
+        if upload_workers:
+            logging.info(f"Peer {id} ignores UploadWorkers, upload workers are only used by the threaded engine")
+        asyncio.run(peer.run(prev_peers))
+        peer.hash_pool.shutdown()
+        peer.checkpoint.close()
+        peer.listening_socket.close()
+        peer.piece_store.close()
+        return
+
     # Initialize PeerProcess
-    peer = PeerProcess(id, host_name, port, has_file, num_pref_nbors, unchoke_int, opt_unchoke_int, file_name, file_size, piece_size, next_peers)
-    
-    # Set up connections to previous peers
-    for prev_peer in prev_peers:
-        peer.add_peer(prev_peer)
+    peer = PeerProcess(id, host_name, port, has_file, num_pref_nbors, unchoke_int, opt_unchoke_int, file_name, file_size, piece_size, next_peers, request_pipeline_depth, endgame, metrics_interval, compression, piece_cache_size, block_size, super_seeding, upload_workers)
     
-    peer.sockets_list = list(peer.connections.values())
-    num_peers = len(peer.connections) + len(peer.next_peers) + 1 # Including itself, otherwise last one gets shut out
-    exponent = int(math.ceil(math.log2((peer.piece_size + 4 + 4 + 1)))) #For going to nearest power of 2 for buffer
-    MAX_MSG_SIZE = 2**(exponent+2) #Giving extra space for buffer
+    num_peers = len(prev_peers) + len(next_peers) + 1 # Including itself, otherwise last one gets shut out
     peer.start_unchoke_timers()
-    peer.start_listening()
-    peer.peer_buffers = {peer: bytearray() for peer in peer.peers_info.keys()}
-    peer.peers_next_length = {peer: 0 for peer in peer.peers_info.keys()}
+    # Connect to every other peer in the background, in whatever order they come up
+    peer.start_listening(prev_peers)
     while peer.peers_with_whole_file < num_peers:
         if len(peer.sockets_list) == 0:
+            # Nothing to read yet, wait for the listener instead of spinning
+            time.sleep(0.05)
             continue
         # Use select to check for readable sockets (those with incoming messages)
-        read_sockets, _, _ = select.select(peer.sockets_list, [], [])
+        # The timeout picks up sockets the listener added while we were waiting
+        read_sockets, _, _ = select.select(peer.sockets_list, [], [], 0.5)
         
         for sock in read_sockets:
-            # Receive the message from the socket
-            buffer = sock.recv(MAX_MSG_SIZE)
-            try:
-                # Find the ID corresponding to the socket that sent the message
-                peer_id = None
-                for key, connection in peer.connections.items():
-                    if connection == sock:
-                        peer_id = key
-                        break
-                peer.peer_buffers[peer_id] += buffer
-                #Read messages
-                while len(peer.peer_buffers[peer_id]) > peer.peers_next_length[peer_id]:
-                    if peer.peers_next_length[peer_id] == 0:
-                        peer.peers_next_length[peer_id] = (int.from_bytes(peer.peer_buffers[peer_id][0:4], byteorder='big'))+4
-                    if len(peer.peer_buffers[peer_id]) < peer.peers_next_length[peer_id]:
-                        #Wait for more message to come in
-                        break
-                    else:
-                        message = peer.peer_buffers[peer_id][0:peer.peers_next_length[peer_id]]
-                        peer.peer_buffers[peer_id] = peer.peer_buffers[peer_id][peer.peers_next_length[peer_id]:]
-                        peer.peers_next_length[peer_id] = 0
-                        peer.read_message(peer_id, message)
+            peer.receive_from(sock)
 
-            except RuntimeError as e:
-                logging.info(f"Error: {e}")
-
-    for conn in peer.connections.values():
-        conn.close()
+    #Let pieces still being verified finish and their have messages go out before closing the sockets
+    peer.connection_manager.stop()
+    peer.scheduler.stop()
+    peer.hash_pool.shutdown()
+    with peer.state_lock:
+        peer.close_outbound(5)
+        if peer.metrics_interval > 0:
+            peer.write_metrics()
+        for conn in peer.connections.values():
+            conn.close()
+    peer.checkpoint.close()
     peer.listening_socket.close()
+    peer.piece_store.close()
 
 
 if __name__ == "__main__":